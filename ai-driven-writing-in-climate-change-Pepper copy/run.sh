@@ -36,3 +36,78 @@ python -m streamlit run src/app.py
 #--new_img_dir "path/to/new_images/" \
 #--database_dir "path/to/image_database/"
 
+
+## Rebuilding the Index (batched encoding) ##
+#python src/RAG.py \
+#--index_path "pth/to/index(.idx)" \
+#--metadata_path "pth/to/metadata(.json)" \
+#--rebuild_index \
+#--batch_size 32
+
+## Approximate Index (IVF or HNSW) with a Recall Report ##
+#python src/RAG.py \
+#--index_path "pth/to/index(.idx)" \
+#--metadata_path "pth/to/metadata(.json)" \
+#--rebuild_index \
+#--index_type ivf --nlist 256 --nprobe 16 \
+#--recall_k 10
+
+## Migrating Metadata to SQLite (then pass the .sqlite path as --metadata_path) ##
+#python src/RAG.py \
+#--index_path "pth/to/index(.idx)" \
+#--metadata_path "pth/to/metadata(.json)" \
+#--migrate_metadata "pth/to/metadata.sqlite"
+
+## Streaming a Large Text File (re-run the same command to resume after an interruption) ##
+#python src/RAG.py \
+#--index_path "pth/to/index(.idx)" \
+#--metadata_path "pth/to/metadata(.json)" \
+#--new_text_file "pth/to/report_dump.txt" \
+#--ingest_batch_size 1024
+
+## Rebuilding with Compressed Vectors (sq8 / fp16 / pq), reporting memory saved and recall ##
+#python src/RAG.py \
+#--index_path "pth/to/index(.idx)" \
+#--metadata_path "pth/to/metadata(.json)" \
+#--rebuild_index \
+#--index_type sq8 \
+#--recall_k 10
+
+## Shared Retrieval Service (one process holds CLIP and the index for every app worker) ##
+#python src/RAG.py \
+#--index_path "pth/to/index(.idx)" \
+#--metadata_path "pth/to/metadata(.json)" \
+#--text_only \
+#--serve --serve_address tcp://127.0.0.1:5560
+
+## App Using the Shared Retrieval Service ##
+#python -m streamlit run src/app.py -- --use_rag \
+#--rag_service tcp://127.0.0.1:5560
+
+## Rebuilding with 4 Worker Processes (re-run the same command to resume after an interruption) ##
+#python src/RAG.py \
+#--index_path "pth/to/index(.idx)" \
+#--metadata_path "pth/to/metadata(.json)" \
+#--rebuild_index \
+#--rebuild_workers 4
+
+## Reusing Indexed Images instead of Generating Illustrations that Match Them ##
+#python -m streamlit run src/app.py -- --use_rag \
+#--index_path "path/to/index.idx" \
+#--metadata_path "path/to/metadata.json" \
+#--reuse_images --image_reuse_threshold 0.3
+
+## Retrieving with the CLIP Embedding of Uploaded Photos, Fused with the Prompt (the app loads the full CLIP model) ##
+#python -m streamlit run src/app.py -- --use_rag \
+#--index_path "path/to/index.idx" \
+#--metadata_path "path/to/metadata.json" \
+#--image_retrieval fused
+
+## Same with the Shared Retrieval Service (start it without --text_only; a --text_only service falls back to the image description) ##
+#python src/RAG.py \
+#--index_path "pth/to/index(.idx)" \
+#--metadata_path "pth/to/metadata(.json)" \
+#--serve --serve_address tcp://127.0.0.1:5560
+#python -m streamlit run src/app.py -- --use_rag \
+#--rag_service tcp://127.0.0.1:5560 \
+#--image_retrieval fused
@@ -1,229 +1,1804 @@
-from sentence_transformers import SentenceTransformer
-from transformers import CLIPProcessor, CLIPModel
 from PIL import Image
 import faiss
 import numpy as np
-import torch
 import json
-import matplotlib.pyplot as plt
 import os
 import argparse
+import bisect
+import contextlib
+import hashlib
+import io
+import re
 import shutil
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from delta_segments import (WriterLock, append_vectors_file, atomic_write_index, list_segments, open_vectors_file,
+                            read_segment, write_segment, write_vectors_file)
+from clip_backends import BACKENDS, DEFAULT_BACKEND, benchmark_backends, create_backend
+from chunking import (DEFAULT_CHUNK_OVERLAP, DEFAULT_CHUNK_TOKENS, DEFAULT_MIN_CHUNK_TOKENS, empty_chunk_stats,
+                      merge_chunk_stats, token_windows)
+from embedding_cache import EmbeddingCache
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from metadata_store import (SQLiteMetadataStore, atomic_write, field_values, load_metadata, migrate_json_to_sqlite,
+                            overlay_metadata, save_metadata, staged_path, write_metadata_file)
+from sharded_rebuild import encode_shard, init_worker, prepare_work_dir, read_shard, rebuild_fingerprint
+from text_stream import checkpoint_path_for, iter_paragraphs, load_checkpoint, save_checkpoint
+
+DEFAULT_CLIP_MODEL = "openai/clip-vit-base-patch32"
+DEFAULT_ENCODE_BATCH_SIZE = 32
+
+# FAISS index types supported by create_new_index. The chosen type and its parameters
+# are stored next to the index in "<index_path>.params.json" and picked up on load.
+INDEX_TYPES = ("flat", "ivf", "hnsw", "sq8", "fp16", "pq")
+# Compressed index types; their exact float32 vectors live in a memory-mapped
+# "<index_path>.vectors.f32" side file used to re-rank the top candidates
+QUANTIZED_INDEX_TYPES = ("sq8", "fp16", "pq")
+DEFAULT_INDEX_PARAMS = {
+    "index_type": "flat",
+    "nlist": 100,            # IVF: number of clusters
+    "nprobe": 10,            # IVF: clusters visited per query
+    "hnsw_m": 32,            # HNSW: neighbours per node
+    "ef_construction": 40,   # HNSW: build-time search depth
+    "ef_search": 64,         # HNSW: query-time search depth
+    "pq_m": 64,              # PQ: sub-quantizers (must divide the embedding size)
+    "pq_nbits": 8,           # PQ: bits per sub-quantizer code
+    "rerank_factor": 4,      # Quantized: candidates re-ranked exactly per requested result
+}
+
+# Metadata attributes whose row-id sets are precomputed at load for filtered search.
+# Other attributes are indexed the first time a query filters on them.
+DEFAULT_FILTER_FIELDS = ("type", "source")
+
+DEFAULT_QUERY_CACHE_SIZE = 1024
+
+# "dense": CLIP/FAISS only, "lexical": BM25 only, "hybrid": both fused by reciprocal rank
+SEARCH_MODES = ("dense", "hybrid", "lexical")
+# Hybrid search fuses this many times k candidates from each side
+HYBRID_FETCH_FACTOR = 4
+# BM25 candidates the dense search is restricted to when pre-filtering
+LEXICAL_PREFILTER_CANDIDATES = 1000
+
+# Paragraphs tokenized per fast-tokenizer call when streaming text files
+TOKENIZE_BATCH_SIZE = 64
+# The title copied onto every chunk of a text is its first sentence, cut at this many characters
+# (a paragraph without a period can be up to text_stream's max_paragraph_chars long)
+MAX_TITLE_CHARS = 200
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Cosine similarity above which a new text/image is treated as a near-duplicate of an indexed one
+DEFAULT_DEDUP_THRESHOLD = 0.97
+
+# Rows that may accumulate in delta segments before a background compaction is started
+DEFAULT_COMPACT_THRESHOLD = 5000
+
+# Text-to-image cosine similarity (CLIP ViT-B/32) above which an indexed image counts as a match
+# for a prompt; fitting captions typically score around 0.28-0.35
+DEFAULT_IMAGE_MATCH_SIMILARITY = 0.3
+
+# Items per checkpointed shard of rebuild_index_sharded
+DEFAULT_SHARD_SIZE = 2048
+
+
+class LRUCache:
+    """
+    Bounded, thread-safe least-recently-used cache with hit/miss counters.
+    """
+
+    def __init__(self, max_size=DEFAULT_QUERY_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
 
 class RAGEngine:
-    def __init__(self, index_path=None, metadata_path=None, clip_model_name="openai/clip-vit-base-patch32"):
+    def __init__(self, index_path=None, metadata_path=None, clip_model_name=DEFAULT_CLIP_MODEL,
+                 encode_batch_size=DEFAULT_ENCODE_BATCH_SIZE, index_params=None,
+                 query_cache_size=DEFAULT_QUERY_CACHE_SIZE, embedding_cache_dir=None,
+                 compact_threshold=DEFAULT_COMPACT_THRESHOLD, dedup_threshold=DEFAULT_DEDUP_THRESHOLD,
+                 inference_backend=DEFAULT_BACKEND, num_threads=None, onnx_dir=None, text_only=False,
+                 mmap_index=False):
+        """
+        Initialize the QueryEngine with required models, index, and metadata.
+        
+        Parameters:
+        - index_path: Path to the FAISS index file.
+        - metadata_path: Path to the metadata file (JSON list, or a .sqlite/.db SQLite store).
+        - encode_batch_size: Number of texts/images pushed through CLIP at once. Bounds peak memory
+          when encoding large corpora.
+        - index_params: Optional overrides of the stored index parameters (see DEFAULT_INDEX_PARAMS),
+          e.g. {"nprobe": 32}. Query-time settings apply immediately; build-time settings apply on
+          the next create_new_index.
+        - query_cache_size: Entries kept in each of the query-embedding and search-result LRU caches
+          (0 disables caching).
+        - embedding_cache_dir: Optional directory of the persistent content-addressed embedding cache.
+          Rebuilds and add_new_data then only run CLIP on content the cache has not seen.
+        - compact_threshold: Delta rows after which ingestion starts a background compaction into the
+          main index (None to compact only on save()/compact()).
+        - dedup_threshold: Cosine similarity at which new content is skipped as a near-duplicate of
+          indexed content (None to skip exact duplicates only).
+        - inference_backend: How CLIP is run: "torch", "torch-int8" (dynamic int8 quantization) or
+          "onnx" (exported graph on onnxruntime). See clip_backends.
+        - num_threads: Intra-op CPU threads for inference (None keeps the library default).
+        - onnx_dir: Directory of the exported ONNX graphs for the onnx backend.
+        - text_only: Load only CLIP's text tower. Faster to start and smaller in memory, for callers
+          that only send text queries; image queries and image ingestion are then unavailable.
+        - mmap_index: Map the index file into memory instead of reading it onto the heap. Loading
+          is near-instant and processes serving the same index share its pages; vectors are
+          paged in from disk as searches touch them.
+        """
+        # Load models
+        self.text_only = text_only
+        self.clip_model, self.clip_processor = _load_clip(clip_model_name, text_only)
+        self.encoder = create_backend(self.clip_model, clip_model_name, inference_backend, num_threads, onnx_dir)
+        # Model part of embedding cache keys. The int8 and ONNX backends produce slightly different
+        # vectors than float32 PyTorch, so they get their own keys; plain torch keeps the bare model
+        # name existing caches were written with.
+        self._cache_model_key = (clip_model_name if self.encoder.name == "torch"
+                                 else f"{clip_model_name}@{self.encoder.name}")
+
+        # Load FAISS index and metadata
+        self.clip_model_name = clip_model_name
+        self.inference_backend = inference_backend
+        self.encode_batch_size = encode_batch_size
+        self.mmap_index = mmap_index
+        self.index_path = index_path
+        self.metadata_path = metadata_path
+        self.index_param_overrides = dict(index_params or {})
+        # Query embeddings only depend on the model; results also depend on the index and are
+        # cleared whenever it changes
+        self._embedding_cache = LRUCache(query_cache_size)
+        self._result_cache = LRUCache(query_cache_size)
+        self.embedding_cache = EmbeddingCache(embedding_cache_dir, self._embedding_dim()) if embedding_cache_dir else None
+        self.compact_threshold = compact_threshold
+        self.dedup_threshold = dedup_threshold
+        # _lock guards the index/metadata references; _compaction_lock allows one compaction at a time
+        self._lock = threading.RLock()
+        self._compaction_lock = threading.Lock()
+        self._compaction_thread = None
+        # Serializes writers across processes; reload never writes
+        self._writer_lock = WriterLock(f"{index_path or 'faiss_index.idx'}.lock")
+        self.reload()
+
+    def reload(self):
+        """
+        (Re)read the FAISS index, metadata and pending delta segments from disk, keeping the
+        loaded CLIP model.
+        """
+        self._finish_interrupted_publish()
+        with self._lock:
+            # The index may not exist yet when it is about to be built with create_new_index
+            self.index = None
+            stored_params = self._load_index_params(self.index_path)
+            index_type = stored_params["index_type"]
+            if self.index_path and os.path.exists(self.index_path):
+                self.index = self._load_faiss_index(self.index_path, self.mmap_index, index_type)
+                # The loaded index is authoritative: the params file may be stale or missing
+                index_type = self._index_type_of(self.index)
+                if index_type != stored_params["index_type"] and os.path.exists(self._params_path()):
+                    print(f"Warning: {self._params_path()} says '{stored_params['index_type']}' but the index is "
+                          f"'{index_type}'; using '{index_type}'.")
+            # An overridden type only takes effect on rebuild
+            self.index_params = {**stored_params, **self.index_param_overrides, "index_type": index_type}
+            if self.index is not None:
+                self._apply_search_params(self.index, self.index_params)
+            self.delta_index = faiss.IndexFlatL2(self.index.d if self.index is not None else self._embedding_dim())
+            self.full_vectors = self._open_full_vectors(self.index, self.index_params)
+            if self.metadata_path:
+                self.metadata = self._load_metadata(self.metadata_path)
+                self._replay_delta_segments()
+                self._build_row_uids()
+                self._build_attribute_index(DEFAULT_FILTER_FIELDS)
+                self._build_article_index()
+            self._content_hashes = None  # built on the first deduplicated ingestion
+            self._lexical_index = None  # built on the first keyword search
+            self._result_cache.clear()
+            self.file_signature = self._current_file_signature()
+
+    def _delta_dir(self):
+        return f"{self.index_path or 'faiss_index.idx'}.delta"
+
+    def _main_rows(self):
+        return self.index.ntotal if self.index is not None else 0
+
+    def _has_unindexed_rows(self):
+        """
+        Whether metadata rows are in neither the main index nor a delta segment (metadata loaded
+        without its index). A knowledge base started empty holds its first rows in delta
+        segments only, until the first compaction builds the main index from them.
+        """
+        return self.index is None and len(self.metadata) > self.delta_index.ntotal
+
+    def _replay_delta_segments(self):
+        """
+        Bring metadata and the in-memory delta index up to date with the segments on disk.
+
+        The main index file is the commit point: metadata rows past its size belong to delta
+        segments (or to a compaction that did not finish) and are re-read from the segments.
+        Loading is read-only: the replayed rows are kept in memory (overlay_metadata), and only
+        a writer persists them or removes compacted segments (see _writing).
+        """
+        segments = list_segments(self._delta_dir())
+        if self.index is None and not segments:
+            return  # metadata waiting for create_new_index
+        committed = self._main_rows()
+        base = committed
+        if len(self.metadata) < committed:
+            print(f"Warning: metadata has {len(self.metadata)} rows but the index has {committed} vectors.")
+            base = len(self.metadata)
+
+        replayed = []
+        for base_row, count, path in segments:
+            if base_row + count <= committed:
+                continue  # already compacted into the main index; removed by the next compaction
+            if base_row != base + len(replayed):
+                print(f"Warning: delta segment {path} does not continue at row {base + len(replayed)}; "
+                      f"ignoring it and later segments.")
+                break
+            vectors, entries = read_segment(path)
+            self.delta_index.add(vectors)
+            replayed.extend(entries)
+        overlay_metadata(self.metadata, base, replayed)
+
+    @contextlib.contextmanager
+    def _writing(self, refresh=True):
+        """
+        Hold the writer lock of the index files. With `refresh`, a writer that finds them changed
+        by another process reloads first, so its rows continue after theirs.
+        """
+        outermost = self._writer_lock.acquire()
+        try:
+            if outermost and refresh and self.changed_on_disk():
+                print("Index files changed on disk; reloading before writing.")
+                self.reload()
+            yield
+        finally:
+            self._writer_lock.release()
+
+    def _ids_path(self):
+        return f"{self.index_path or 'faiss_index.idx'}.ids.json"
+
+    def _build_row_uids(self):
+        """
+        Resolve the stable ID of every metadata row and which rows are live.
+
+        Entries carry their ID in "uid"; entries written before IDs existed use their row. An
+        update appends a new version with the same ID, so every row whose ID appears again in a
+        later row is superseded; IDs listed in the ids file were deleted.
+        """
+        state = {"deleted": [], "next_uid": 0}
+        if os.path.exists(self._ids_path()):
+            with open(self._ids_path(), "r", encoding="utf-8") as f:
+                state.update(json.load(f))
+        self._deleted_uids = set(state["deleted"])
+        uids = np.fromiter((row if uid is None else uid for row, uid in field_values(self.metadata, "uid")),
+                           dtype=np.int64, count=len(self.metadata))
+        self._row_uids = uids
+        self._dead_rows = np.zeros(len(uids), dtype=bool)
+        if len(uids):
+            _, last_from_end = np.unique(uids[::-1], return_index=True)
+            self._dead_rows[:] = True
+            self._dead_rows[len(uids) - 1 - last_from_end] = False
+            if self._deleted_uids:
+                self._dead_rows |= np.isin(uids, list(self._deleted_uids))
+        self._next_uid = max(int(state["next_uid"]), int(uids.max()) + 1 if len(uids) else 0)
+
+    def _save_ids(self):
+        payload = json.dumps({"deleted": sorted(self._deleted_uids), "next_uid": self._next_uid}).encode("utf-8")
+        atomic_write(self._ids_path(), lambda f: f.write(payload))
+
+    def _live_row(self, uid):
+        """
+        Metadata row holding the current version of `uid` (ValueError if unknown or deleted).
+        """
+        rows = np.flatnonzero(self._row_uids == uid)
+        if not len(rows) or self._dead_rows[rows[-1]]:
+            raise ValueError(f"No live entry with id {uid}.")
+        return int(rows[-1])
+
+    def entry_ids(self, rows):
+        """
+        Stable IDs of metadata rows, e.g. of the indices returned by query (-1 for missing results).
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        valid = (rows >= 0) & (rows < len(self._row_uids))
+        return np.where(valid, self._row_uids[np.where(valid, rows, 0)], -1)
+
+    def _kill_rows(self, rows):
+        """
+        Hide superseded or deleted rows from every search and from article expansion.
+        """
+        self._dead_rows[rows] = True
+        for row in rows:
+            self._remove_article_chunk(row)
+        self._selector_cache = {}
+        self._result_cache.clear()
+        self._content_hashes = None
+
+    def _vectors_path(self):
+        return f"{self.index_path or 'faiss_index.idx'}.vectors.f32"
+
+    def _open_full_vectors(self, index, params):
+        """
+        Memory-map the exact vectors of a quantized index (None for exact index types).
+        """
+        if index is None or params["index_type"] not in QUANTIZED_INDEX_TYPES:
+            return None
+        vectors = open_vectors_file(self._vectors_path(), index.ntotal, index.d)
+        if vectors is None:
+            print(f"Warning: {self._vectors_path()} is missing or incomplete; "
+                  f"results come from the compressed vectors without re-ranking.")
+        return vectors
+
+    def _params_path(self):
+        return f"{self.index_path}.params.json" if self.index_path else None
+
+    def _current_file_signature(self):
+        return _file_signature(self.index_path, self.metadata_path, self._params_path(), self._delta_dir(),
+                               self._ids_path())
+
+    def changed_on_disk(self):
+        """
+        True if the index, its params file, the metadata or the delta segments changed since this
+        engine last read or wrote them.
+        """
+        return self.file_signature != self._current_file_signature()
+
+    @staticmethod
+    def _load_faiss_index(index_path, mmap=False, index_type="flat"):
+        """
+        Read an index file, optionally memory-mapped: IVF inverted lists, and the flat/SQ/HNSW
+        storage on FAISS versions with IO_FLAG_MMAP_IFC, are then used in place from the file.
+        A memory-mapped index is read-only; changes go through a private copy (see compact).
+        """
+        if not mmap:
+            return faiss.read_index(index_path)
+        ivf = index_type in ("ivf", "pq")  # pq is built as IVF1,PQ
+        flags = faiss.IO_FLAG_MMAP if ivf else getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+        try:
+            return faiss.read_index(index_path, flags)
+        except RuntimeError as e:
+            print(f"Error: could not memory-map {index_path} ({str(e).splitlines()[0]}); reading it instead.")
+            return faiss.read_index(index_path)
+
+    @staticmethod
+    def _index_type_of(index):
+        """
+        The INDEX_TYPES name of a loaded FAISS index.
+        """
+        if isinstance(index, faiss.IndexIVFPQ):
+            return "pq"  # built as IVF1,PQ
+        if faiss.try_extract_index_ivf(index) is not None:
+            return "ivf"
+        if isinstance(index, faiss.IndexHNSW):
+            return "hnsw"
+        if isinstance(index, faiss.IndexScalarQuantizer):
+            return "fp16" if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+        return "flat"
+
+    @staticmethod
+    def _load_index_params(index_path):
+        """
+        Read the index type and parameters stored next to the index. Indexes built before
+        the params file existed are exact flat indexes. On load, the type of the index file
+        itself takes precedence (see _index_type_of).
+        """
+        params = dict(DEFAULT_INDEX_PARAMS)
+        params_path = f"{index_path}.params.json" if index_path else None
+        if params_path and os.path.exists(params_path):
+            with open(params_path, "r", encoding="utf-8") as f:
+                params.update(json.load(f))
+        return params
+
+    @staticmethod
+    def _build_faiss_index(embeddings, params):
+        """
+        Create, train and fill a FAISS index of the requested type.
+
+        Parameters:
+        - embeddings: (n, dim) float32 array of normalized embeddings.
+        - params: Dict with "index_type" and its parameters (see DEFAULT_INDEX_PARAMS).
+
+        Returns:
+        - The populated FAISS index.
+        """
+        index_type = params["index_type"]
+        dimension = embeddings.shape[1]
+        if index_type == "flat":
+            index = faiss.IndexFlatL2(dimension)
+        elif index_type == "ivf":
+            # IVF cannot have more clusters than training points
+            nlist = max(1, min(int(params["nlist"]), len(embeddings)))
+            index = faiss.index_factory(dimension, f"IVF{nlist},Flat")
+            index.train(embeddings)
+        elif index_type == "hnsw":
+            index = faiss.index_factory(dimension, f"HNSW{int(params['hnsw_m'])},Flat")
+            index.hnsw.efConstruction = int(params["ef_construction"])
+        elif index_type in ("sq8", "fp16"):
+            index = faiss.index_factory(dimension, "SQ8" if index_type == "sq8" else "SQfp16")
+            index.train(embeddings)
+        elif index_type == "pq":
+            pq_m = int(params["pq_m"])
+            if dimension % pq_m:
+                raise ValueError(f"pq_m={pq_m} must divide the embedding size {dimension}.")
+            # Each sub-quantizer needs at least 2**nbits training points
+            nbits = int(params["pq_nbits"])
+            while nbits > 1 and len(embeddings) < 2 ** nbits:
+                nbits -= 1
+            # A single inverted list scans every code like IndexPQ, but supports ID selectors
+            index = faiss.index_factory(dimension, f"IVF1,PQ{pq_m}x{nbits}")
+            index.train(embeddings)
+        else:
+            raise ValueError(f"Unknown index type '{index_type}'. Choose from {', '.join(INDEX_TYPES)}.")
+        index.add(embeddings)
+        return index
+
+    @staticmethod
+    def _apply_search_params(index, params):
+        """
+        Push the query-time settings (nprobe / efSearch) into a loaded index.
+        """
+        parameter_space = faiss.ParameterSpace()
+        if params["index_type"] == "ivf":
+            parameter_space.set_index_parameter(index, "nprobe", int(params["nprobe"]))
+        elif params["index_type"] == "hnsw":
+            parameter_space.set_index_parameter(index, "efSearch", int(params["ef_search"]))
+
+    @staticmethod
+    def _load_metadata(metadata_path):
+        # JSON list, or a SQLiteMetadataStore for .sqlite/.sqlite3/.db paths
+        return load_metadata(metadata_path)
+
+    @staticmethod
+    def _normalize_embeddings(embeddings):
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return embeddings / norms
+
+    def _embedding_dim(self):
+        return self.clip_model.config.projection_dim
+
+    def _encode_batched(self, items, encode_batch, batch_size=None, progress_callback=None):
+        """
+        Encode items in fixed-size batches into a preallocated float32 array.
+
+        Only one batch of model inputs is alive at a time, so peak memory is bounded by
+        the batch size rather than by the corpus size.
+
+        Parameters:
+        - items: List of inputs (texts, PIL images or image paths).
+        - encode_batch: Function mapping a list of items to a (len(batch), dim) array.
+        - batch_size: Items per batch (defaults to self.encode_batch_size).
+        - progress_callback: Optional callable(done, total) invoked after every batch.
+
+        Returns:
+        - (len(items), dim) float32 numpy array.
+        """
+        batch_size = batch_size or self.encode_batch_size
+        embeddings = np.empty((len(items), self._embedding_dim()), dtype=np.float32)
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            embeddings[start:start + len(batch)] = encode_batch(batch)
+            if progress_callback:
+                progress_callback(start + len(batch), len(items))
+        return embeddings
+
+    def _encode_text(self, texts, batch_size=None, progress_callback=None):
+        def encode_batch(batch):
+            inputs = self.clip_processor(text=batch, return_tensors="pt", padding=True, truncation=True)
+            return self.encoder.text_features(inputs)
+
+        return self._encode_batched(list(texts), encode_batch, batch_size, progress_callback)
+
+    def _encode_image(self, images=None, image_paths=None, batch_size=None, progress_callback=None):
+        if self.text_only:
+            raise ValueError("This RAGEngine was started with text_only=True and cannot encode images.")
+
+        def encode_batch(batch):
+            if image_paths:
+                # Open the images of this batch only; they are released before the next batch
+                batch = [self._open_image(path) for path in batch]
+            inputs = self.clip_processor(images=batch, return_tensors="pt", padding=True)
+            return self.encoder.image_features(inputs)
+
+        if image_paths:
+            items = list(image_paths)
+        elif isinstance(images, (list, tuple)):
+            items = list(images)
+        else:
+            items = [images]
+        return self._encode_batched(items, encode_batch, batch_size, progress_callback)
+
+    def _encode_cached(self, hashes, encode_missing, progress_callback=None):
+        """
+        Normalized embeddings for items identified by content hash, running the model only on
+        items missing from the persistent embedding cache.
+
+        Parameters:
+        - hashes: Content hash per item (None when no cache is configured).
+        - encode_missing: Callable(positions, progress_callback) returning raw embeddings for those items.
+        - progress_callback: Optional callable(done, total); cache hits count as done.
+        """
+        total = len(hashes)
+        if self.embedding_cache is None:
+            return self._normalize_embeddings(encode_missing(list(range(total)), progress_callback))
+
+        cached = self.embedding_cache.get_many(hashes)
+        embeddings = np.empty((total, self._embedding_dim()), dtype=np.float32)
+        missing = []
+        for position, key in enumerate(hashes):
+            if key in cached:
+                embeddings[position] = cached[key]
+            else:
+                missing.append(position)
+        hits = total - len(missing)
+
+        if missing:
+            def report(done, _total):
+                if progress_callback:
+                    progress_callback(hits + done, total)
+
+            new_embeddings = self._normalize_embeddings(encode_missing(missing, report))
+            embeddings[missing] = new_embeddings
+            self.embedding_cache.put_many([hashes[position] for position in missing], new_embeddings)
+        elif progress_callback and total:
+            progress_callback(total, total)
+        return embeddings
+
+    def _encode_texts_cached(self, texts, batch_size=None, progress_callback=None):
+        hashes = [None] * len(texts)
+        if self.embedding_cache is not None:
+            hashes = [EmbeddingCache.content_hash(self._cache_model_key, "text", text) for text in texts]
+        return self._encode_cached(
+            hashes,
+            lambda positions, report: self._encode_text([texts[i] for i in positions], batch_size, report),
+            progress_callback,
+        )
+
+    def _encode_images_cached(self, images=None, image_paths=None, batch_size=None, progress_callback=None, hashes=None):
+        """
+        Like _encode_image, but through the embedding cache. Image files are keyed by their bytes,
+        in-memory images by their pixels; when both are given the paths are used for the key and the
+        already decoded images for encoding. Precomputed keys can be passed as `hashes`.
+        """
+        count = len(image_paths) if image_paths else len(images)
+        if hashes is None:
+            hashes = [None] * count
+        if self.embedding_cache is not None and not any(hashes):
+            if image_paths:
+                hashes = [EmbeddingCache.file_hash(self._cache_model_key, "image", path) for path in image_paths]
+            else:
+                hashes = [
+                    EmbeddingCache.content_hash(self._cache_model_key, "pixels", f"{img.mode}{img.size}".encode() + img.tobytes())
+                    for img in images
+                ]
+
+        def encode_missing(positions, report):
+            if images:
+                return self._encode_image(images=[images[i] for i in positions], batch_size=batch_size, progress_callback=report)
+            return self._encode_image(image_paths=[image_paths[i] for i in positions], batch_size=batch_size, progress_callback=report)
+
+        return self._encode_cached(hashes, encode_missing, progress_callback)
+
+    def _clip_image_size(self):
+        """
+        Shortest image side CLIP's preprocessing resizes to (224 for the ViT-B/32 model).
+        """
+        size = getattr(self.clip_processor.image_processor, "size", None) or {}
+        return int(size.get("shortest_edge") or min(size.get("height", 224), size.get("width", 224)))
+
+    def _decode_for_clip(self, path):
+        """
+        Read and decode one image file, downscaled early to the resolution CLIP actually uses.
+
+        JPEGs are decoded at reduced scale (PIL draft mode), so the full-resolution bitmap of a
+        large photo is never materialised. Runs in the ingestion worker threads.
+
+        Returns:
+        - (path, image, content_hash), with image None and content_hash the error if decoding failed.
+        """
+        target = self._clip_image_size()
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            key = None
+            if self.embedding_cache is not None:
+                key = EmbeddingCache.content_hash(self._cache_model_key, "image", data)
+            with Image.open(io.BytesIO(data)) as img:
+                img.draft("RGB", (target, target))
+                img = img.convert("RGB")
+            scale = target / min(img.size)
+            if scale < 1:
+                img = img.resize((max(target, round(img.width * scale)), max(target, round(img.height * scale))),
+                                 Image.BICUBIC)
+            return path, img, key
+        except Exception as e:
+            return path, None, e
+
+    def ingest_image_dir(self, img_dir, database_dir, batch_size=None, workers=None, max_in_flight=None,
+                         progress_callback=None, dedup_threshold=None):
+        """
+        Add every image of `img_dir` to the knowledge base through a decode/encode pipeline.
+
+        Worker threads read and decode images (downscaled to CLIP's input size) while the
+        calling thread encodes the previous batch. At most `max_in_flight` decoded images
+        exist at any time, so memory does not depend on the size of the folder. Each batch
+        is committed as a delta segment once its files are copied to `database_dir`; they are
+        removed from `img_dir` after the commit.
+
+        Parameters:
+        - img_dir: Directory containing the new images.
+        - database_dir: Image database directory the files are moved to.
+        - batch_size: Images per CLIP forward pass (defaults to self.encode_batch_size).
+        - workers: Decoding threads (defaults to the CPU count, at most 8).
+        - max_in_flight: Images read/decoded ahead of the encoder (defaults to 2 * batch_size).
+        - progress_callback: Optional callable(done, total) invoked after every batch.
+        - dedup_threshold: Near-duplicate similarity threshold (defaults to self.dedup_threshold).
+          Duplicates are reported and left in `img_dir`.
+
+        Returns:
+        - List of the new image paths in `database_dir`.
+        """
+        if not os.path.isdir(img_dir) or not os.path.isdir(database_dir):
+            print(f"Error: Directory not found at {img_dir} or {database_dir}")
+            return []
+        if self._has_unindexed_rows():
+            print("Error: the metadata has not been indexed yet; run create_new_index before adding data.")
+            return []
+
+        paths = sorted(
+            os.path.join(img_dir, filename) for filename in os.listdir(img_dir)
+            if filename.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        batch_size = batch_size or self.encode_batch_size
+        workers = workers or min(8, os.cpu_count() or 1)
+        max_in_flight = max(max_in_flight or 2 * batch_size, batch_size)
+        added_paths = []
+        done = 0
+
+        def commit(batch):
+            nonlocal done
+            embeddings = self._encode_images_cached(
+                images=[img for _, img, _ in batch], batch_size=batch_size, hashes=[key for _, _, key in batch]
+            )
+            first_row = len(self.metadata)
+            new_paths = [os.path.join(database_dir, os.path.basename(path)) for path, _, _ in batch]
+            candidates = [{"type": "image", "image_path": path} for path, _, _ in batch]
+            keep, report = self._find_duplicates(embeddings, candidates, dedup_threshold)
+            self._print_dedup_report(report, candidates)
+            # Files are copied to database_dir before their rows are committed and removed from
+            # img_dir after, so a row never points at a missing file and an interrupted or failed
+            # import leaves the images in img_dir for a rerun
+            copied = []
+            for i in keep:
+                try:
+                    shutil.copy2(batch[i][0], new_paths[i])
+                except OSError as e:
+                    print(f"Error copying image {batch[i][0]}: {e}")
+                    continue
+                copied.append(i)
+            embeddings = embeddings[copied]
+            sources = [batch[i][0] for i in copied]
+            new_paths = [new_paths[i] for i in copied]
+            entries = [
+                {
+                    "type": "image",
+                    "ID": f"{first_row + idx}",  # Unique ID for image
+                    "title": os.path.basename(new_path).replace("_", " ").split(".")[0],  # Use filename as title
+                    "summary": "",
+                    "content": "",
+                    "source": "User Upload",
+                    "image_path": new_path,
+                }
+                for idx, new_path in enumerate(new_paths)
+            ]
+            if entries:
+                try:
+                    self._append_entries(embeddings, entries)
+                except BaseException:
+                    for new_path in new_paths:
+                        if os.path.exists(new_path):
+                            os.remove(new_path)
+                    raise
+            for path in sources:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"Error removing imported image {path}: {e}")
+            added_paths.extend(new_paths)
+            done += len(candidates)
+            if progress_callback:
+                progress_callback(done, len(paths))
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag-image-decode") as pool:
+            in_flight = deque()
+            pending_paths = iter(paths)
+
+            def fill():
+                while len(in_flight) < max_in_flight:
+                    path = next(pending_paths, None)
+                    if path is None:
+                        return
+                    in_flight.append(pool.submit(self._decode_for_clip, path))
+
+            fill()
+            batch = []
+            while in_flight:
+                path, img, key = in_flight.popleft().result()
+                fill()
+                if img is None:
+                    print(f"Error processing image {path}: {key}")
+                    done += 1
+                    continue
+                batch.append((path, img, key))
+                if len(batch) >= batch_size:
+                    commit(batch)
+                    batch = []
+            if batch:
+                commit(batch)
+        return added_paths
+
+    @staticmethod
+    def _open_image(path):
+        with Image.open(path) as img:
+            return img.convert("RGB")
+
+    @staticmethod
+    def _split_chunk_id(entry_id):
+        """
+        Split a text chunk ID such as "12.3" into ("12", 3.0); None if it is not a chunk ID.
+        """
+        main_id, _, chunk_no = str(entry_id).partition(".")
+        try:
+            return main_id, float(chunk_no)
+        except ValueError:
+            return None
+
+    def _build_article_index(self):
+        """
+        Group text chunk rows by article (the ID part before the dot), sorted by chunk number.
+        Built once at load and kept current by _append_entries.
+        """
+        self._article_chunks = {}
+        self._row_article = {}
+        text_rows = set(self._attribute_rows.get("type", {}).get("text", []))
+        for row, entry_id in field_values(self.metadata, "ID"):
+            if row in text_rows and not self._dead_rows[row]:
+                self._add_article_chunk(row, entry_id)
+
+    def _add_article_chunk(self, row, entry_id):
+        parts = self._split_chunk_id(entry_id)
+        if parts is None:
+            return
+        main_id, chunk_no = parts
+        bisect.insort(self._article_chunks.setdefault(main_id, []), (chunk_no, row))
+        self._row_article[row] = main_id
+
+    def _remove_article_chunk(self, row):
+        main_id = self._row_article.pop(row, None)
+        if main_id is not None:
+            chunks = self._article_chunks[main_id]
+            chunks[:] = [chunk for chunk in chunks if chunk[1] != row]
+
+    def _next_article_id(self):
+        numeric_ids = [int(main_id) for main_id in self._article_chunks if main_id.isdigit()]
+        return max([len(self.metadata)] + [main_id + 1 for main_id in numeric_ids])
+
+    def _count_tokens(self, texts):
+        """
+        CLIP tokens of each text, counted as the chunker counts them (one batched tokenizer call).
+        """
+        encoded = self.clip_processor.tokenizer(list(texts), add_special_tokens=False)
+        return [len(input_ids) for input_ids in encoded["input_ids"]]
+
+    def _expand_hit(self, row, retrieval_mode="chunk", neighbor_window=1, article_token_budget=None):
+        """
+        Turn one retrieved chunk into the context passed to the LLM.
+
+        Parameters:
+        - row: Metadata row of the retrieved chunk.
+        - retrieval_mode: "chunk" (the chunk only), "neighbors" (neighbor_window chunks on each
+          side) or "article" (the whole article).
+        - neighbor_window: Chunks taken on each side in "neighbors" mode.
+        - article_token_budget: Optional cap on CLIP tokens per result. Chunks are added outward from
+          the retrieved one, alternating sides, until the next one would exceed the budget.
+
+        Returns:
+        - (article id or None, combined content).
+        """
+        main_id = self._row_article.get(row)
+        if retrieval_mode == "chunk" or main_id is None:
+            return main_id, self.metadata[row]['content']
+
+        chunk_rows = [chunk_row for _, chunk_row in self._article_chunks[main_id]]
+        position = chunk_rows.index(row)
+        if retrieval_mode == "neighbors":
+            first = max(0, position - neighbor_window)
+            chunk_rows = chunk_rows[first:position + neighbor_window + 1]
+            position -= first
+        elif retrieval_mode != "article":
+            raise ValueError(f"Unknown retrieval_mode '{retrieval_mode}'. Use 'chunk', 'neighbors' or 'article'.")
+
+        contents = {chunk_row: self.metadata[chunk_row]['content'] for chunk_row in chunk_rows}
+        if article_token_budget is None:
+            return main_id, " ".join(contents[chunk_row] for chunk_row in chunk_rows)
+
+        tokens = dict(zip(chunk_rows, self._count_tokens([contents[chunk_row] for chunk_row in chunk_rows])))
+        selected = {row}
+        used = tokens[row]
+        left, right = position - 1, position + 1
+        while left >= 0 or right < len(chunk_rows):
+            for side in (right, left):
+                if 0 <= side < len(chunk_rows):
+                    cost = tokens[chunk_rows[side]]
+                    if used + cost > article_token_budget:
+                        left, right = -1, len(chunk_rows)  # budget reached, stop expanding
+                        break
+                    selected.add(chunk_rows[side])
+                    used += cost
+            else:
+                left, right = left - 1, right + 1
+        return main_id, " ".join(contents[chunk_row] for chunk_row in chunk_rows if chunk_row in selected)
+
+    def combine_chunks_based_on_id(self, indices, metadata=None, article_token_budget=None):
+        """
+        Return the full article of every retrieved chunk, using the precomputed article index.
+
+        Parameters:
+        - indices: FAISS result indices (as returned by query).
+        - metadata: Unused; kept for backward compatibility.
+        - article_token_budget: Optional per-article token cap (see _expand_hit).
+        """
+        return [
+            self._expand_hit(idx, "article", article_token_budget=article_token_budget)[1]
+            for idx in indices[0] if 0 <= idx < len(self.metadata)
+        ]
+
+    def _build_attribute_index(self, fields):
+        """
+        Precompute, for each field, the metadata rows holding each value.
+        """
+        self._attribute_rows = {}
+        self._selector_cache = {}
+        for field in fields:
+            self._index_attribute(field)
+
+    def _index_attribute(self, field):
+        rows_by_value = {}
+        for row, value in field_values(self.metadata, field):
+            if isinstance(value, (str, int, float, bool, type(None))):
+                rows_by_value.setdefault(value, []).append(row)
+        self._attribute_rows[field] = rows_by_value
+
+    def _update_attribute_index(self, first_row, entries):
+        """
+        Add the rows of newly appended entries to the attribute index.
+        """
+        for field, rows_by_value in self._attribute_rows.items():
+            for row, entry in enumerate(entries, start=first_row):
+                value = entry.get(field)
+                if isinstance(value, (str, int, float, bool, type(None))):
+                    rows_by_value.setdefault(value, []).append(row)
+        self._selector_cache = {}
+
+    @staticmethod
+    def _filters_key(filters):
+        return tuple(sorted(
+            (field, tuple(sorted(map(str, value))) if isinstance(value, (list, tuple, set)) else str(value))
+            for field, value in (filters or {}).items()
+        ))
+
+    def _filter_selector(self, filters):
+        """
+        Build (and cache) a FAISS ID selector for the rows matching every filter.
+
+        Parameters:
+        - filters: Dict of metadata field -> value, or -> list of accepted values.
+
+        Returns:
+        - (selector over main index rows, selector over delta index rows, number of matching rows).
+        """
+        key = self._filters_key(filters)
+        if key in self._selector_cache:
+            return self._selector_cache[key][:3]
+
+        mask = self._build_filter_mask(filters)
+        selectors = self._mask_selectors(mask)
+        self._selector_cache[key] = selectors + (mask,)
+        return selectors[:3]
+
+    def _filter_mask(self, filters):
+        """
+        Boolean array over metadata rows matching every filter (None when there are no filters).
+        """
+        if not filters and not self._dead_rows.any():
+            return None
+        self._filter_selector(filters or {})
+        return self._selector_cache[self._filters_key(filters)][5]
+
+    def _build_filter_mask(self, filters):
+        total_rows = len(self.metadata)
+        # Superseded and deleted rows never match
+        mask = ~self._dead_rows
+        for field, value in filters.items():
+            if field not in self._attribute_rows:
+                self._index_attribute(field)
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            field_mask = np.zeros(total_rows, dtype=bool)
+            for accepted in values:
+                rows = self._attribute_rows[field].get(accepted, [])
+                field_mask[rows] = True
+            mask &= field_mask
+        return mask
+
+    def _mask_selectors(self, mask):
+        """
+        FAISS selectors for the rows set in `mask`.
+
+        Returns:
+        - (main selector, delta selector, number of rows, main bitmap, delta bitmap); the bitmaps
+          must be kept alive as long as the selectors point at them.
+        """
+        # Delta rows are numbered from 0 inside the delta index
+        main_rows = self._main_rows()
+        main_bitmap = np.packbits(mask[:main_rows], bitorder="little")
+        delta_bitmap = np.packbits(mask[main_rows:], bitorder="little")
+        return (faiss.IDSelectorBitmap(main_bitmap), faiss.IDSelectorBitmap(delta_bitmap), int(mask.sum()),
+                main_bitmap, delta_bitmap)
+
+    def _add_lexical_row(self, row, entry):
+        if entry.get("type") == "text":
+            self._lexical_index.add(row, entry.get("title", ""), entry.get("content", ""))
+        else:
+            self._lexical_index.add(row)
+
+    def _ensure_lexical_index(self):
+        """
+        BM25 index over title/content, built on first use and kept current by _append_entries.
+        """
+        with self._lock:
+            if self._lexical_index is None:
+                start = time.perf_counter()
+                self._lexical_index = BM25Index()
+                for row, entry in enumerate(self.metadata):
+                    self._add_lexical_row(row, entry)
+                print(f"Built BM25 index over {len(self._lexical_index)} rows in {time.perf_counter() - start:.2f}s")
+            return self._lexical_index
+
+    def lexical_search(self, text_query, k=10, filters=None):
+        """
+        Keyword search with BM25 over the title and content of the metadata.
+
+        Parameters:
+        - text_query: Keyword query.
+        - k: Number of rows to return (None for every matching row).
+        - filters: Metadata constraints as in query (None for no constraint).
+
+        Returns:
+        - (rows, scores) numpy arrays, best first.
+        """
+        lexical_index = self._ensure_lexical_index()
+        with self._lock:
+            allowed = self._filter_mask(filters)
+        return lexical_index.search(text_query, k=k, allowed=allowed)
+
+    def _search_parameters(self, selector):
+        """
+        FAISS search parameters carrying the selector plus the stored nprobe / efSearch.
+        """
+        index_type = self.index_params["index_type"]
+        if index_type == "ivf":
+            return faiss.SearchParametersIVF(sel=selector, nprobe=int(self.index_params["nprobe"]))
+        if index_type == "pq":
+            return faiss.SearchParametersIVF(sel=selector, nprobe=1)
+        if index_type == "hnsw":
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=int(self.index_params["ef_search"]))
+        return faiss.SearchParameters(sel=selector)
+
+    def _search(self, embeddings, k, filters=None, candidate_rows=None):
+        """
+        Search the main index and the delta index, restricting candidates to rows matching
+        `filters` inside FAISS so that k qualifying results come back without over-fetching.
+        `candidate_rows` further restricts the search to those rows (e.g. keyword matches).
+        """
+        with self._lock:
+            index, delta_index, main_rows = self.index, self.delta_index, self._main_rows()
+            full_vectors = self.full_vectors
+            main_selector = delta_selector = None
+            if candidate_rows is not None:
+                mask = np.zeros(len(self.metadata), dtype=bool)
+                mask[candidate_rows] = True
+                filter_mask = self._filter_mask(filters)
+                if filter_mask is not None:
+                    mask &= filter_mask
+                selectors = self._mask_selectors(mask)  # bitmaps stay referenced until we return
+                main_selector, delta_selector, matching = selectors[:3]
+                if matching == 0:
+                    return (np.full((len(embeddings), k), np.inf, dtype=np.float32),
+                            np.full((len(embeddings), k), -1, dtype=np.int64))
+            elif filters or self._dead_rows.any():
+                main_selector, delta_selector, matching = self._filter_selector(filters or {})
+                if matching == 0:
+                    return (np.full((len(embeddings), k), np.inf, dtype=np.float32),
+                            np.full((len(embeddings), k), -1, dtype=np.int64))
+
+        distances = np.full((len(embeddings), k), np.inf, dtype=np.float32)
+        indices = np.full((len(embeddings), k), -1, dtype=np.int64)
+        if index is not None and main_rows:
+            params = self._search_parameters(main_selector) if main_selector is not None else None
+            distances, indices = self._search_main(index, embeddings, k, params, full_vectors)
+        if delta_index.ntotal:
+            params = faiss.SearchParameters(sel=delta_selector) if delta_selector is not None else None
+            delta_distances, delta_indices = delta_index.search(embeddings, k, params=params)
+            delta_indices = np.where(delta_indices >= 0, delta_indices + main_rows, -1)
+            distances, indices = self._merge_results(distances, indices, delta_distances, delta_indices, k)
+        if candidate_rows is not None:
+            # FAISS pads with the largest float when fewer than k candidates exist
+            distances[indices < 0] = np.inf
+        return distances, indices
+
+    def _search_main(self, index, embeddings, k, params=None, full_vectors=None):
+        """
+        Search the main index. For quantized indexes, rerank_factor * k candidates are fetched
+        from the compressed codes and re-ranked with exact distances to the float32 side file.
+        """
+        if full_vectors is None:
+            return index.search(embeddings, k, params=params)
+        candidates = min(index.ntotal, max(k, k * int(self.index_params["rerank_factor"])))
+        _, candidate_ids = index.search(embeddings, candidates, params=params)
+        return self._rerank(embeddings, candidate_ids, full_vectors, k)
+
+    @staticmethod
+    def _rerank(embeddings, candidate_ids, full_vectors, k, chunk=256):
+        """
+        Exact squared L2 distances between each query and its candidates, keeping the k nearest.
+        """
+        distances = np.full((len(embeddings), k), np.inf, dtype=np.float32)
+        indices = np.full((len(embeddings), k), -1, dtype=np.int64)
+        for start in range(0, len(embeddings), chunk):
+            ids = candidate_ids[start:start + chunk]
+            # Only the candidate rows are read from the memory-mapped file
+            vectors = full_vectors[np.maximum(ids, 0)]
+            exact = ((vectors - embeddings[start:start + chunk, None, :]) ** 2).sum(axis=2)
+            exact[ids < 0] = np.inf
+            order = np.argsort(exact, axis=1)[:, :k]
+            kept = min(k, ids.shape[1])
+            distances[start:start + chunk, :kept] = np.take_along_axis(exact, order, axis=1)
+            indices[start:start + chunk, :kept] = np.where(
+                np.isfinite(distances[start:start + chunk, :kept]), np.take_along_axis(ids, order, axis=1), -1)
+        return distances, indices
+
+    @staticmethod
+    def _merge_results(distances, indices, other_distances, other_indices, k):
+        """
+        Merge two per-query result lists, keeping the k nearest of each row.
+        """
+        distances = np.hstack([distances, other_distances])
+        indices = np.hstack([indices, other_indices])
+        distances[indices < 0] = np.inf
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+    def query(self, text_query=None, image=None, k=5, text_weight=0.5, image_weight=0.5, filters=None,
+              retrieval_mode="chunk", neighbor_window=1, article_token_budget=None, search_mode="dense",
+              lexical_prefilter=False):
+        """
+        Query the FAISS index using a combined text and image query.
+        
+        Parameters:
+        - text_query: A string representing the text query.
+        - image: A PIL.Image object representing the image query.
+        - k: Number of results to retrieve.
+        - text_weight: Weight for the text embedding in the combined query.
+        - image_weight: Weight for the image embedding in the combined query.
+        - filters: Metadata constraints applied inside the search, e.g. {"type": "text",
+          "source": ["BBC", "NASA"]}. Defaults to text entries only.
+        - retrieval_mode: "chunk" returns the matched chunks, "neighbors" adds neighbor_window
+          chunks on each side, "article" returns whole articles (each article at most once).
+        - neighbor_window: Chunks added on each side in "neighbors" mode.
+        - article_token_budget: Optional per-result token cap for "neighbors" / "article" modes.
+        - search_mode: "dense" (CLIP embeddings), "lexical" (BM25 keywords over title/content) or
+          "hybrid" (both, fused by reciprocal rank). Keyword-heavy prompts do better with hybrid.
+        - lexical_prefilter: Restrict the dense search to the best BM25 matches of the text query
+          (falls back to the full search when no keyword matches).
+        
+        Returns:
+        - List of relevant text retrieved from the metadata, with the distances and indices of the hits.
+          In "hybrid" mode distances are the dense distances (inf for rows only found by keywords);
+          in "lexical" mode they are negated BM25 scores, so smaller is still better.
+        """
+        return self.query_batch(
+            [text_query], [image], k=k, text_weight=text_weight, image_weight=image_weight, filters=filters,
+            retrieval_mode=retrieval_mode, neighbor_window=neighbor_window, article_token_budget=article_token_budget,
+            search_mode=search_mode, lexical_prefilter=lexical_prefilter,
+        )[0]
+
+    def query_batch(self, text_queries=None, images=None, k=5, text_weight=0.5, image_weight=0.5, filters=None,
+                    retrieval_mode="chunk", neighbor_window=1, article_token_budget=None, batch_size=None,
+                    search_mode="dense", lexical_prefilter=False):
+        """
+        Run many queries at once: uncached texts and images are each encoded in batched CLIP passes,
+        and all queries not in the result cache are answered by a single FAISS search.
+
+        Parameters:
+        - text_queries: List of text queries (entries may be None for image-only queries).
+        - images: List of PIL.Image queries, paired with text_queries by position (entries may be None).
+        - batch_size: Items per CLIP forward pass (defaults to self.encode_batch_size).
+        - k, text_weight, image_weight, filters, retrieval_mode, neighbor_window, article_token_budget,
+          search_mode, lexical_prefilter: As in query, applied to every query.
+
+        Returns:
+        - List with one (results, distances, indices) tuple per query, as returned by query.
+        """
+        if filters is None:
+            filters = {"type": "text"}
+        if search_mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{search_mode}'. Choose from {', '.join(SEARCH_MODES)}.")
+        text_queries = list(text_queries) if text_queries is not None else []
+        images = list(images) if images is not None else []
+        count = max(len(text_queries), len(images))
+        if text_queries and images and len(text_queries) != len(images):
+            raise ValueError("text_queries and images must have the same length when both are given.")
+        text_queries = text_queries or [None] * count
+        images = images or [None] * count
+
+        text_embeddings = self._cached_query_embeddings(
+            [("text", self._normalize_query_text(text)) if text else None for text in text_queries],
+            lambda positions: self._encode_text([text_queries[i] for i in positions], batch_size))
+        image_embeddings = self._cached_query_embeddings(
+            [("image", self._image_hash(image)) if image else None for image in images],
+            lambda positions: self._encode_image(images=[images[i] for i in positions], batch_size=batch_size))
+
+        combined = np.zeros((count, self._embedding_dim()), dtype=np.float32)
+        for position in range(count):
+            if text_embeddings[position] is not None:
+                combined[position] += text_weight * text_embeddings[position]
+            if image_embeddings[position] is not None:
+                combined[position] += image_weight * image_embeddings[position]
+
+        filters_key = self._filters_key(filters)
+        outputs = [None] * count
+        result_keys = []
+        pending = []
+        for position in range(count):
+            result_key = (
+                hashlib.sha1(combined[position].tobytes()).hexdigest(), k, text_weight, image_weight,
+                filters_key, retrieval_mode, neighbor_window, article_token_budget, search_mode, lexical_prefilter,
+                self._normalize_query_text(text_queries[position]) if text_queries[position] and search_mode != "dense" else None,
+            )
+            result_keys.append(result_key)
+            cached = self._result_cache.get(result_key)
+            if cached is not None:
+                results, distances, indices = cached
+                outputs[position] = (list(results), distances.copy(), indices.copy())
+            else:
+                pending.append(position)
+
+        if pending:
+            fetch = k if search_mode == "dense" else k * HYBRID_FETCH_FACTOR
+            if search_mode != "lexical" and not lexical_prefilter:
+                # One search over every uncached query, only over entries matching the filters
+                distances, indices = self._search(combined[pending], fetch, filters)
+            for row, position in enumerate(pending):
+                if lexical_prefilter or search_mode != "dense":
+                    query_distances, query_indices = self._keyword_search_one(
+                        text_queries[position], combined[position:position + 1], k, fetch, filters, search_mode,
+                        lexical_prefilter, None if lexical_prefilter or search_mode == "lexical"
+                        else (distances[row:row + 1], indices[row:row + 1]))
+                else:
+                    query_distances, query_indices = distances[row:row + 1].copy(), indices[row:row + 1].copy()
+                results = self._collect_results(query_indices[0], retrieval_mode, neighbor_window, article_token_budget)
+                self._result_cache.put(result_keys[position], (list(results), query_distances.copy(), query_indices.copy()))
+                outputs[position] = (results, query_distances, query_indices)
+        return outputs
+
+    def match_image(self, text_query, min_similarity=DEFAULT_IMAGE_MATCH_SIMILARITY):
+        """
+        Find the indexed image closest to a text prompt (e.g. an illustration prompt), if it is close enough.
+
+        Works with text_only engines: the image embeddings are already in the index.
+
+        Parameters:
+        - text_query: The prompt.
+        - min_similarity: Cosine similarity between the prompt and image embeddings required for a match.
+
+        Returns:
+        - Dict with row, uid, image_path and similarity, or None when no image is similar enough.
+        """
+        embedding = self._cached_query_embeddings(
+            [("text", self._normalize_query_text(text_query))], lambda positions: self._encode_text([text_query]))[0]
+        distances, indices = self._search(embedding[None, :].astype(np.float32), 1, {"type": "image"})
+        row = int(indices[0][0])
+        if row < 0:
+            return None
+        # Squared L2 between unit vectors is 2 - 2 * cosine
+        similarity = 1.0 - float(distances[0][0]) / 2.0
+        if similarity < min_similarity:
+            return None
+        return {"row": row, "uid": int(self.entry_ids([row])[0]), "image_path": self.metadata[row].get("image_path"),
+                "similarity": similarity}
+
+    def _keyword_search_one(self, text_query, embedding, k, fetch, filters, search_mode, lexical_prefilter,
+                            dense=None):
+        """
+        Lexical, pre-filtered or hybrid search for one query.
+
+        Parameters:
+        - text_query: The query text (keyword side; None for image-only queries).
+        - embedding: (1, dim) combined query embedding (dense side).
+        - fetch: Candidates taken from each side before fusion.
+        - dense: Precomputed (distances, indices) of the full dense search, if any.
+
+        Returns:
+        - (distances, indices) of shape (1, k), as described in query.
+        """
+        lexical_rows = lexical_scores = np.empty(0, dtype=np.int64)
+        if text_query:
+            wanted = max(fetch, LEXICAL_PREFILTER_CANDIDATES if lexical_prefilter else 0)
+            lexical_rows, lexical_scores = self.lexical_search(text_query, k=wanted, filters=filters)
+
+        if search_mode == "lexical":
+            distances = np.full((1, k), np.inf, dtype=np.float32)
+            indices = np.full((1, k), -1, dtype=np.int64)
+            found = min(k, len(lexical_rows))
+            distances[0, :found] = -lexical_scores[:found]
+            indices[0, :found] = lexical_rows[:found]
+            return distances, indices
+
+        if dense is None:
+            candidates = lexical_rows[:LEXICAL_PREFILTER_CANDIDATES] if lexical_prefilter and len(lexical_rows) else None
+            dense = self._search(embedding, fetch, filters, candidate_rows=candidates)
+        dense_distances, dense_indices = dense
+        if search_mode == "dense":
+            return dense_distances[:, :k].copy(), dense_indices[:, :k].copy()
+
+        fused_rows, _ = reciprocal_rank_fusion([dense_indices[0], lexical_rows[:fetch]])
+        dense_distance = {int(row): distance for row, distance in zip(dense_indices[0], dense_distances[0]) if row >= 0}
+        distances = np.full((1, k), np.inf, dtype=np.float32)
+        indices = np.full((1, k), -1, dtype=np.int64)
+        for rank, row in enumerate(fused_rows[:k]):
+            indices[0, rank] = row
+            distances[0, rank] = dense_distance.get(int(row), np.inf)
+        return distances, indices
+
+    def _collect_results(self, indices, retrieval_mode="chunk", neighbor_window=1, article_token_budget=None):
+        """
+        Retrieve the metadata of one query's hits, expanded to neighbouring chunks or articles if requested.
+        """
+        results = []
+        seen_articles = set()
+        for idx in indices:
+            if not 0 <= idx < len(self.metadata):
+                continue
+            main_id, content = self._expand_hit(idx, retrieval_mode, neighbor_window, article_token_budget)
+            if retrieval_mode != "chunk" and main_id is not None:
+                if main_id in seen_articles:
+                    continue
+                seen_articles.add(main_id)
+            results.append(content)
+        return results
+
+    @staticmethod
+    def _normalize_query_text(text):
+        """
+        Cache key for near-identical prompts: case, punctuation and spacing are ignored.
+        """
+        return " ".join(re.sub(r"[^\w\s]", " ", text.casefold()).split())
+
+    @staticmethod
+    def _image_hash(image):
+        digest = hashlib.sha1(f"{image.mode}{image.size}".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def _cached_query_embeddings(self, keys, encode):
+        """
+        Normalized query embeddings from the LRU cache; the misses are computed together with
+        `encode(positions)`. Positions whose key is None get None.
+        """
+        embeddings = [None] * len(keys)
+        missing = []
+        for position, key in enumerate(keys):
+            if key is None:
+                continue
+            embedding = self._embedding_cache.get(key)
+            if embedding is None:
+                missing.append(position)
+            else:
+                embeddings[position] = embedding.copy()
+        if missing:
+            # Duplicate queries in the batch are encoded once
+            unique = list(dict.fromkeys(keys[position] for position in missing))
+            first_position = {}
+            for position in missing:
+                first_position.setdefault(keys[position], position)
+            encoded = self._normalize_embeddings(encode([first_position[key] for key in unique]))
+            for key, embedding in zip(unique, encoded):
+                self._embedding_cache.put(key, embedding)
+            by_key = dict(zip(unique, encoded))
+            for position in missing:
+                embeddings[position] = by_key[keys[position]].copy()
+        return embeddings
+
+    def cache_stats(self):
+        """
+        Hit/miss counters of the query-embedding and search-result caches.
+        """
+        return {"embeddings": self._embedding_cache.stats(), "results": self._result_cache.stats()}
+    
+
+    def create_new_index(self, batch_size=None, progress_callback=None, index_params=None, recall_k=None):
+        """
+        Re-encode every metadata entry and rebuild the FAISS index from scratch.
+
+        Texts and images are encoded in batches of `batch_size`, and the embeddings are
+        written at their metadata row so index row i always matches metadata[i].
+
+        Parameters:
+        - batch_size: Items per CLIP forward pass (defaults to self.encode_batch_size).
+        - progress_callback: Optional callable(done, total) invoked after every batch.
+        - index_params: Index type and parameters to build with (defaults to the stored ones),
+          e.g. {"index_type": "ivf", "nlist": 256, "nprobe": 16}.
+        - recall_k: If set, also report recall@recall_k of the new index against exact search.
+
+        Returns:
+        - Dict with the number of items encoded, elapsed seconds and items_per_sec (plus "recall").
+        """
+        #with open(metadata_path, "r", encoding="utf-8") as f:
+        #    metadata = json.load(f)
+
+        entries = self._live_entries()
+        text_rows, text_data = [], []
+        image_rows, image_paths = [], []
+        for row, entry in enumerate(entries):
+            if entry['type'] == 'text':
+                text_rows.append(row)
+                text_data.append(entry['content'])
+            elif entry['type'] == 'image':
+                image_rows.append(row)
+                image_paths.append(entry['image_path'])
+
+        total = len(text_data) + len(image_paths)
+
+        def report(done, _total, offset=0):
+            if progress_callback:
+                progress_callback(offset + done, total)
+
+        start = time.perf_counter()
+        embeddings = np.zeros((len(entries), self._embedding_dim()), dtype=np.float32)
+        if text_data:
+            embeddings[text_rows] = self._encode_texts_cached(text_data, batch_size=batch_size, progress_callback=report)
+        if image_paths:
+            embeddings[image_rows] = self._encode_images_cached(
+                image_paths=image_paths,
+                batch_size=batch_size,
+                progress_callback=lambda done, _total: report(done, _total, offset=len(text_data)),
+            )
+        elapsed = time.perf_counter() - start
+
+        # Normalize embeddings
+        embeddings = self._normalize_embeddings(embeddings)
+        self._publish_index(embeddings, index_params, entries)
+
+        stats = {"items": total, "seconds": elapsed, "items_per_sec": total / elapsed if elapsed > 0 else 0.0}
+        print(f"Encoded {total} items in {elapsed:.1f}s ({stats['items_per_sec']:.1f} items/sec)")
+        if self.embedding_cache is not None:
+            stats["embedding_cache"] = self.embedding_cache.stats()
+            print(f"Embedding cache: {stats['embedding_cache']}")
+        stats["memory"] = self.memory_report()
+        if recall_k:
+            stats["recall"] = self.recall_report(k=recall_k, embeddings=embeddings)
+        return stats
+
+    def rebuild_index_sharded(self, workers=None, shard_size=DEFAULT_SHARD_SIZE, batch_size=None,
+                              progress_callback=None, index_params=None, recall_k=None, work_dir=None):
         """
-        Initialize the QueryEngine with required models, index, and metadata.
-        
+        Rebuild the FAISS index like create_new_index, encoding the metadata in parallel worker
+        processes and checkpointing every encoded shard.
+
+        The metadata rows to encode (those not already in the embedding cache) are split into
+        shards of `shard_size` items. Each worker process loads its own CLIP model and writes a
+        shard file once the shard is encoded. A killed rebuild resumes from the shards on disk,
+        as long as the metadata, model and shard size are unchanged. The shards are then merged
+        into the index at self.index_path and the checkpoint directory is removed.
+
         Parameters:
-        - index_path: Path to the FAISS index file.
-        - metadata_path: Path to the metadata JSON file.
+        - workers: Worker processes (default: half the CPUs, at most 4; each holds a CLIP model).
+        - shard_size: Items per shard, i.e. the work lost at most per worker when interrupted.
+        - batch_size: Items per CLIP forward pass (defaults to self.encode_batch_size).
+        - progress_callback: Optional callable(done, total) invoked after every shard.
+        - index_params: Index type and parameters to build with, as in create_new_index.
+        - recall_k: If set, also report recall@recall_k of the new index against exact search.
+        - work_dir: Checkpoint directory (default: "<index_path>.rebuild").
+
+        Returns:
+        - Dict with items, encoded (items run through CLIP in this call), resumed (items taken
+          from checkpoints), seconds, items_per_sec and workers (plus "recall").
         """
-        # Load models
-        self.clip_model = CLIPModel.from_pretrained(clip_model_name)
-        self.clip_processor = CLIPProcessor.from_pretrained(clip_model_name)
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        import multiprocessing
 
-        # Load FAISS index and metadata
-        self.index_path = index_path
-        self.metadata_path = metadata_path
-        if self.index_path:
-            self.index = self._load_faiss_index(index_path)
-        if self.metadata_path:
-            self.metadata = self._load_metadata(metadata_path)
+        if not self.index_path:
+            raise ValueError("rebuild_index_sharded needs an index_path to write the index to.")
+        if shard_size < 1:
+            raise ValueError("shard_size must be at least 1.")
+        cpus = os.cpu_count() or 1
+        workers = workers or max(1, min(4, cpus // 2))
+        batch_size = batch_size or self.encode_batch_size
+        work_dir = work_dir or f"{self.index_path}.rebuild"
 
-    @staticmethod
-    def _load_faiss_index(index_path):
-        return faiss.read_index(index_path)
+        entries = self._live_entries()
+        items = []
+        for row, entry in enumerate(entries):
+            if entry['type'] == 'text':
+                items.append((row, "text", entry['content']))
+            elif entry['type'] == 'image':
+                items.append((row, "image", entry['image_path']))
 
-    @staticmethod
-    def _load_metadata(metadata_path):
-        with open(metadata_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        start = time.perf_counter()
+        embeddings = np.zeros((len(entries), self._embedding_dim()), dtype=np.float32)
+        hashes = {}
+        if self.embedding_cache is not None:
+            for row, kind, payload in items:
+                hashes[row] = (EmbeddingCache.content_hash(self._cache_model_key, "text", payload) if kind == "text"
+                               else EmbeddingCache.file_hash(self._cache_model_key, "image", payload))
+            cached = self.embedding_cache.get_many(list(hashes.values()))
+            todo = []
+            for item in items:
+                if hashes[item[0]] in cached:
+                    embeddings[item[0]] = cached[hashes[item[0]]]
+                else:
+                    todo.append(item)
+        else:
+            todo = items
 
-    @staticmethod
-    def _normalize_embeddings(embeddings):
-        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        shards = [todo[i:i + shard_size] for i in range(0, len(todo), shard_size)]
+        done_shards = prepare_work_dir(work_dir, rebuild_fingerprint(self._cache_model_key, shard_size, todo))
+        pending = [shard for shard in range(len(shards)) if shard not in done_shards]
+        resumed = sum(len(shards[shard]) for shard in range(len(shards)) if shard in done_shards)
+        done = len(items) - len(todo) + resumed
+        if resumed:
+            print(f"Resuming rebuild from {work_dir}: {len(shards) - len(pending)}/{len(shards)} shards already encoded")
+        if progress_callback:
+            progress_callback(done, len(items))
 
-    def _encode_text(self, texts):
-        inputs = self.clip_processor(text=texts, return_tensors="pt", padding=True, truncation=True)
-        with torch.no_grad():
-            text_embeddings = self.clip_model.get_text_features(**inputs)
-        return text_embeddings.cpu().numpy()
+        if pending:
+            text_only = all(kind == "text" for shard in pending for _, kind, _ in shards[shard])
+            threads = max(1, cpus // workers)
+            # spawn: forked children would inherit the parent's torch/FAISS thread pools
+            with ProcessPoolExecutor(max_workers=min(workers, len(pending)),
+                                     mp_context=multiprocessing.get_context("spawn"), initializer=init_worker,
+                                     initargs=(self.clip_model_name, self.inference_backend, threads, text_only, work_dir)) as pool:
+                futures = [
+                    pool.submit(encode_shard, work_dir, shard, [kind for _, kind, _ in shards[shard]],
+                                [payload for _, _, payload in shards[shard]], batch_size)
+                    for shard in pending
+                ]
+                for future in as_completed(futures):
+                    _, count, _ = future.result()
+                    done += count
+                    if progress_callback:
+                        progress_callback(done, len(items))
 
-    def _encode_image(self, images=None, image_paths=None):
-        if image_paths:
-            images = [Image.open(path).convert("RGB") for path in image_paths]
-        inputs = self.clip_processor(images=images, return_tensors="pt", padding=True)
-        with torch.no_grad():
-            image_embeddings = self.clip_model.get_image_features(**inputs)
-        return image_embeddings.cpu().numpy()
-
-    def combine_chunks_based_on_id(self, indices, metadata):
-        # Create a dictionary to store the full articles
-        results = []
-        
-        # Step 1: Group entries by their main ID (before the dot)
-        grouped_by_article = {}
-        
-        # Populate the grouped dictionary with content based on main ID
-        for entry in metadata:
-            if entry.get('type') == 'text':  # We only care about text entries
-                main_id = entry['ID'].split('.')[0]  # Get the part before the dot (e.g., '1' from '1.1')
-                if main_id not in grouped_by_article:
-                    grouped_by_article[main_id] = []
-                grouped_by_article[main_id].append(entry)
-        
-        # Step 2: For each index in the provided indices list, find the corresponding article
-        for idx in indices[0]:
-            if idx < len(metadata):
-                # Get the main ID of the selected entry
-                selected_entry = metadata[idx]
-                main_id = selected_entry['ID'].split('.')[0]
-                
-                # Get all entries with the same main ID
-                article_chunks = [entry for entry in grouped_by_article.get(main_id, [])]
-                
-                # Step 3: Sort chunks by the chunk number (after the dot) and combine them
-                article_chunks_sorted = sorted(article_chunks, key=lambda x: float(x['ID'].split('.')[1]))  # Sort by chunk number
-                
-                # Combine all content for the full article
-                full_article = " ".join([entry['content'] for entry in article_chunks_sorted])
-                
-                # Add the combined full article to the results
-                results.append(full_article)
+        for shard, shard_items in enumerate(shards):
+            rows = [row for row, _, _ in shard_items]
+            embeddings[rows] = read_shard(work_dir, shard)
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_many([hashes[row] for row in rows], embeddings[rows])
+        elapsed = time.perf_counter() - start
 
-        return results
+        self._publish_index(embeddings, index_params, entries)
+        shutil.rmtree(work_dir, ignore_errors=True)
 
+        encoded = len(todo) - resumed
+        stats = {"items": len(items), "encoded": encoded, "resumed": resumed, "seconds": elapsed,
+                 "items_per_sec": encoded / elapsed if elapsed > 0 else 0.0, "workers": workers}
+        print(f"Encoded {encoded} of {len(items)} items with {workers} worker processes in {elapsed:.1f}s "
+              f"({stats['items_per_sec']:.1f} items/sec; {resumed} resumed from checkpoints)")
+        if self.embedding_cache is not None:
+            stats["embedding_cache"] = self.embedding_cache.stats()
+        stats["memory"] = self.memory_report()
+        if recall_k:
+            stats["recall"] = self.recall_report(k=recall_k, embeddings=embeddings)
+        return stats
 
-    def query(self, text_query=None, image=None, k=5, text_weight=0.5, image_weight=0.5):
+    def _live_entries(self):
         """
-        Query the FAISS index using a combined text and image query.
-        
-        Parameters:
-        - text_query: A string representing the text query.
-        - image: A PIL.Image object representing the image query.
-        - k: Number of results to retrieve.
-        - text_weight: Weight for the text embedding in the combined query.
-        - image_weight: Weight for the image embedding in the combined query.
-        
-        Returns:
-        - List of relevant text retrieved from the metadata.
+        The metadata to rebuild from: self.metadata itself, or a list without the superseded and
+        deleted rows (each keeping its stable ID) when there are any.
         """
-        combined_embedding = None
+        if not self._dead_rows.any():
+            return self.metadata
+        return [{**entry, "uid": int(self._row_uids[row])}
+                for row, entry in enumerate(self.metadata) if not self._dead_rows[row]]
 
-        # Encode text query if provided
-        if text_query:
-            text_embedding = self._normalize_embeddings(self._encode_text([text_query]))
-            combined_embedding = text_weight * text_embedding
-
-        # Encode image query if provided
-        if image:
-            image_embedding = self._normalize_embeddings(self._encode_image(image))
-            if combined_embedding is None:
-                combined_embedding = image_weight * image_embedding
+    def _publish_manifest_path(self):
+        return f"{self.index_path or 'faiss_index.idx'}.publish.json"
+
+    def _finish_interrupted_publish(self):
+        """
+        Complete or roll back a renumbering publish that was interrupted (see _publish_index).
+
+        The manifest records the identity of the index file the publish replaced. If the index
+        on disk is still that file, the new index was never committed and the staged files are
+        discarded; otherwise they are swapped in as the publish would have done.
+        """
+        manifest_path = self._publish_manifest_path()
+        if not os.path.exists(manifest_path):
+            return
+        with self._writing(refresh=False):
+            if not os.path.exists(manifest_path):
+                return  # the publish we waited for has finished
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            committed = _file_identity(self.index_path) != manifest["replaced_index"]
+            if committed:
+                self._apply_staged_files(manifest)
             else:
-                combined_embedding += image_weight * image_embedding
+                for staged, _ in manifest["files"]:
+                    for leftover in (staged, f"{staged}-journal"):
+                        if os.path.exists(leftover):
+                            os.remove(leftover)
+            os.remove(manifest_path)
+            print(f"{'Completed' if committed else 'Rolled back'} an interrupted index rebuild of {self.index_path}.")
 
-        # Query the FAISS index
-        distances, indices = self.index.search(combined_embedding, k)
+    @staticmethod
+    def _apply_staged_files(manifest):
+        for staged, final in manifest["files"]:
+            if os.path.exists(staged):
+                os.replace(staged, final)
+        for path in manifest["remove"]:
+            if os.path.exists(path):
+                os.remove(path)
 
-        # Retrieve corresponding metadata, only for 'text' entries
-        #results = self.combine_chunks_based_on_id(indices, self.metadata)
-        results = [self.metadata[idx]['content'] for idx in indices[0] if idx < len(self.metadata) and self.metadata[idx].get('type') == 'text']
-        
-        return results, distances, indices
-    
+    def _publish_index(self, embeddings, index_params=None, entries=None):
+        """
+        Build the FAISS index over normalized `embeddings` (row i = entries[i]) and make it the
+        main index, replacing any delta segments. `entries` (from _live_entries) replace the
+        metadata when they are not self.metadata itself.
 
-    def create_new_index(self):
-        #with open(metadata_path, "r", encoding="utf-8") as f:
-        #    metadata = json.load(f)
+        Dropping rows renumbers the metadata, so it must not change before the new index is
+        committed. The renumbered metadata, ids file and exact vectors are then staged next to
+        their files and listed in a manifest, and are swapped in once the index is written; a
+        load after a crash finishes or rolls back the swap (_finish_interrupted_publish).
+        """
+        # Create FAISS index
+        params = {**self.index_params, **self.index_param_overrides, **(index_params or {})}
+        index = self._build_faiss_index(embeddings, params)
+        self._apply_search_params(index, params)
 
-        embeddings = []
+        # Publish metadata (the exact vectors of a quantized index and the parameters it was built
+        # with), then the FAISS index: the commit point.
+        # Every row, including those from delta segments, is now in the main index.
+        quantized = params["index_type"] in QUANTIZED_INDEX_TYPES
+        with self._writing(refresh=False), self._lock:
+            self.index_path = self.index_path or "faiss_index.idx"
+            dropped = entries is not None and entries is not self.metadata
+            if dropped:
+                manifest = {
+                    "replaced_index": _file_identity(self.index_path),
+                    "files": [[staged_path(path), path] for path in (self.metadata_path, self._ids_path())],
+                    "remove": [path for _, _, path in list_segments(self._delta_dir())],
+                }
+                write_metadata_file(entries, staged_path(self.metadata_path))
+                ids = json.dumps({"deleted": [], "next_uid": self._next_uid}).encode("utf-8")
+                atomic_write(staged_path(self._ids_path()), lambda f: f.write(ids))
+                if quantized:
+                    write_vectors_file(staged_path(self._vectors_path()), embeddings)
+                    manifest["files"].append([staged_path(self._vectors_path()), self._vectors_path()])
+            else:
+                save_metadata(self.metadata, self.metadata_path)
+                if quantized:
+                    write_vectors_file(self._vectors_path(), embeddings)
+            payload = json.dumps(params, indent=4).encode("utf-8")
+            atomic_write(self._params_path(), lambda f: f.write(payload))
+            if dropped:
+                manifest_payload = json.dumps(manifest).encode("utf-8")
+                atomic_write(self._publish_manifest_path(), lambda f: f.write(manifest_payload))
+            atomic_write_index(index, self.index_path)
+            if dropped:
+                if isinstance(self.metadata, SQLiteMetadataStore):
+                    self.metadata.close()
+                self._apply_staged_files(manifest)
+                os.remove(self._publish_manifest_path())
+                self.metadata = (self._load_metadata(self.metadata_path)
+                                 if isinstance(self.metadata, SQLiteMetadataStore) else entries)
+            if self.mmap_index:
+                # Swap the freshly built heap copy for the mapped file
+                index = self._load_faiss_index(self.index_path, True, params["index_type"])
+                self._apply_search_params(index, params)
+            if not quantized and os.path.exists(self._vectors_path()):
+                os.remove(self._vectors_path())
+            for _, _, path in list_segments(self._delta_dir()):
+                os.remove(path)
+            self.index = index
+            self.delta_index = faiss.IndexFlatL2(index.d)
+            self.index_params = params
+            self.full_vectors = self._open_full_vectors(index, params)
+            if dropped:
+                # Deleted IDs are gone from the metadata now; rows were renumbered
+                self._build_row_uids()
+                self._build_attribute_index(DEFAULT_FILTER_FIELDS)
+                self._build_article_index()
+                self._lexical_index = None
+                self._content_hashes = None
+            self._selector_cache = {}
+            self._result_cache.clear()
+            self.file_signature = self._current_file_signature()
 
-        text_data = []
-        image_paths = []
-        for entry in self.metadata:
-            if entry['type'] == 'text':
-                text_data.append(entry['content'])
-            elif entry['type'] == 'image':
-                image_paths.append(entry['image_path'])
+    def memory_report(self):
+        """
+        Size of the main index compared to the same vectors in an exact float32 flat index.
 
-        text_embedding = self._encode_text(text_data)
-        embeddings.append(text_embedding)
-        image_embedding = self._encode_image(image_paths=image_paths)
-        embeddings.append(image_embedding)
+        Returns:
+        - Dict with index_type, index_bytes, float32_bytes, saved_bytes and saved_fraction.
+        """
+        if self.index is None:
+            return None
+        index_bytes = 0
 
-        # Normalize embeddings
-        embeddings = np.vstack(embeddings)
-        embeddings = self._normalize_embeddings(embeddings)
+        def count(data):
+            nonlocal index_bytes
+            index_bytes += len(data)
+            return len(data)
 
-        # Create FAISS index
-        dimension = embeddings.shape[1]
-        index = faiss.IndexFlatL2(dimension)
-        index.reset()
-        index.add(embeddings)
+        faiss.write_index(self.index, faiss.PyCallbackIOWriter(count))
+        float32_bytes = self.index.ntotal * self.index.d * np.dtype(np.float32).itemsize
+        report = {
+            "index_type": self.index_params["index_type"],
+            "index_bytes": index_bytes,
+            "float32_bytes": float32_bytes,
+            "saved_bytes": float32_bytes - index_bytes,
+            "saved_fraction": 1 - index_bytes / float32_bytes if float32_bytes else 0.0,
+        }
+        side_file = " (exact vectors memory-mapped from disk for re-ranking)" if self.full_vectors is not None else ""
+        print(f"Index memory ({report['index_type']}): {index_bytes / 2**20:.1f} MiB vs {float32_bytes / 2**20:.1f} MiB "
+              f"as float32, {max(report['saved_fraction'], 0.0):.0%} saved{side_file}")
+        return report
+
+    def _reconstruct_vectors(self):
+        """
+        Read all stored vectors back out of the current index (exact ones from the side file
+        of a quantized index).
+        """
+        if self.full_vectors is not None:
+            return np.array(self.full_vectors)
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            ivf.make_direct_map()
+        return self.index.reconstruct_n(0, self.index.ntotal)
+
+    def recall_report(self, k=10, n_queries=200, embeddings=None, seed=0):
+        """
+        Measure recall@k and query latency of the current index against an exact flat index.
+
+        Stored vectors are sampled as queries, so no model forward pass is needed. Quantized
+        indexes are measured with their exact re-ranking, and also without it.
 
-        # Save FAISS index
-        faiss.write_index(index, "faiss_index.idx")
+        Parameters:
+        - k: Number of neighbours compared per query.
+        - n_queries: Number of sampled queries.
+        - embeddings: The indexed vectors; reconstructed from the index if omitted.
+        - seed: Random seed for the query sample.
+
+        Returns:
+        - Dict with index_type, k, n_queries, recall and mean per-query latency (ms) of both indexes
+          (plus recall_without_rerank for quantized indexes).
+        """
+        if embeddings is None:
+            embeddings = self._reconstruct_vectors()
+        exact = faiss.IndexFlatL2(embeddings.shape[1])
+        exact.add(embeddings)
+
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(len(embeddings), size=min(n_queries, len(embeddings)), replace=False)
+        queries = embeddings[sample]
+        k = min(k, len(embeddings))
+
+        start = time.perf_counter()
+        _, exact_ids = exact.search(queries, k)
+        exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        start = time.perf_counter()
+        _, approx_ids = self._search_main(self.index, queries, k, full_vectors=self.full_vectors)
+        approx_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+        def recall(ids):
+            hits = sum(len(set(a) & set(e)) for a, e in zip(ids.tolist(), exact_ids.tolist()))
+            return hits / (k * len(queries))
+
+        report = {
+            "index_type": self.index_params["index_type"],
+            "k": k,
+            "n_queries": len(queries),
+            "recall": recall(approx_ids),
+            "index_ms_per_query": approx_ms,
+            "flat_ms_per_query": exact_ms,
+        }
+        print(
+            f"Recall@{k} of {report['index_type']} vs exact flat over {len(queries)} queries: {report['recall']:.3f} "
+            f"({approx_ms:.3f} ms/query vs {exact_ms:.3f} ms/query)"
+        )
+        if self.full_vectors is not None:
+            _, compressed_ids = self.index.search(queries, k)
+            report["recall_without_rerank"] = recall(compressed_ids)
+            print(f"Recall@{k} from the compressed codes alone (no re-ranking): {report['recall_without_rerank']:.3f}")
+        return report
 
-    def add_new_data(self, new_texts=None, imgs=None, img_pths=None, chunk_size=100, min_chunk_size=10):
+    def add_new_data(self, new_texts=None, imgs=None, img_pths=None, chunk_tokens=DEFAULT_CHUNK_TOKENS,
+                     chunk_overlap=DEFAULT_CHUNK_OVERLAP, min_chunk_tokens=DEFAULT_MIN_CHUNK_TOKENS,
+                     dedup_threshold=None):
         """
         Add new text or image data to the FAISS index and metadata, with chunking for long texts.
         
         Parameters:
         - new_texts: List of new text entries to add.
         - new_images: List of new PIL.Image objects to add.
+        - chunk_tokens, chunk_overlap, min_chunk_tokens: CLIP-token chunking (see _chunk_texts).
+        - dedup_threshold: Near-duplicate similarity threshold (defaults to self.dedup_threshold).
         
-        Updates the index and metadata in-place.
+        Updates the index and metadata in-place. Exact and near-duplicates of indexed content are skipped.
+
+        Returns:
+        - Chunking stats of the texts (see _chunk_texts) plus "added", "duplicates_exact" and "duplicates_near".
         """
         new_embeddings = []
         new_metadata = []
-        current_topic_id = len(self.metadata)
+        current_topic_id = self._next_article_id()
+        stats = empty_chunk_stats()
+        if self._has_unindexed_rows():
+            print("Error: the metadata has not been indexed yet; run create_new_index before adding data.")
+            stats.update(added=0, duplicates_exact=0, duplicates_near=0)
+            return stats
 
         if new_texts:
-            chunked_texts = []
-            chunked_ids = []
-            chunked_titles = []
-            chunked_summaries = []
-            
-            for text_idx, text in enumerate(new_texts):
-                words = text.split()
-                title = text.split(".")[0]  # Use the first sentence as the title
-                summary = " ".join(words[:20])  # First 20 words as a summary
-                if len(words) <= chunk_size:
-                    if len(words) >= min_chunk_size:  # Keep only valid chunks
-                        chunked_texts.append(text)
-                        chunked_ids.append(f"{current_topic_id}.1")  # Assign chunk ID
-                        chunked_titles.append(title)
-                        chunked_summaries.append(summary)
-                else:
-                    chunks = [words[i:i + chunk_size] for i in range(0, len(words), chunk_size)]
-                    if len(chunks) > 1 and len(chunks[-1]) < min_chunk_size:
-                        chunks[-2].extend(chunks[-1])
-                        chunks.pop()
-                    for sub_idx, chunk in enumerate(chunks, start=1):
-                        if len(chunk) >= min_chunk_size:
-                            chunked_texts.append(' '.join(chunk))
-                            chunked_ids.append(f"{current_topic_id}.{sub_idx}")
-                            chunked_titles.append(title)
-                            chunked_summaries.append(summary)
-                current_topic_id += 1  # Increment topic ID
-            text_embeddings = self._normalize_embeddings(self._encode_text(chunked_texts))
-            new_embeddings.append(text_embeddings)
-            for idx, (chunk, chunk_id, title, summary) in enumerate(zip(chunked_texts, chunked_ids, chunked_titles, chunked_summaries)):
-                new_metadata.append({
-                    "type": "text",
-                    "ID": chunk_id,
-                    "title": title,
-                    "summary": summary,
-                    "content": chunk,
-                    "source": "User Input"  # Change if needed
-                })
+            text_metadata, stats = self._chunk_texts(new_texts, current_topic_id, chunk_tokens, chunk_overlap,
+                                                     min_chunk_tokens)
+            self._print_chunk_stats(stats)
+            if text_metadata:
+                text_embeddings = self._encode_texts_cached([entry["content"] for entry in text_metadata])
+                new_embeddings.append(text_embeddings)
+                new_metadata.extend(text_metadata)
 
         if img_pths:
-            image_embeddings = self._normalize_embeddings(
-                np.vstack([self._encode_image(image) for image in imgs])
-            )
+            image_embeddings = self._encode_images_cached(images=imgs, image_paths=img_pths)
             new_embeddings.append(image_embeddings)
             for idx, img_pth in enumerate(img_pths):
                 img_id = f"{len(self.metadata) + len(new_metadata) + idx}"  # Unique ID for image
@@ -237,11 +1812,534 @@ class RAGEngine:
                     "image_path": img_pth
                 })
             
+        stats.update(added=0, duplicates_exact=0, duplicates_near=0)
         if new_embeddings:
-            combined_embeddings = np.vstack(new_embeddings)
-            self.index.add(combined_embeddings)
-            self.metadata.extend(new_metadata)
-        self.save()
+            embeddings = np.vstack(new_embeddings)
+            keep, report = self._find_duplicates(embeddings, new_metadata, dedup_threshold)
+            self._print_dedup_report(report, new_metadata)
+            stats.update(added=len(keep), duplicates_exact=report["exact"], duplicates_near=report["near"])
+            if keep:
+                self._append_entries(embeddings[keep], [new_metadata[i] for i in keep])
+        return stats
+
+    def _token_offsets(self, texts):
+        """
+        Character offsets of the CLIP tokens of each text (one batched fast-tokenizer call).
+        """
+        encoded = self.clip_processor.tokenizer(list(texts), add_special_tokens=False, return_offsets_mapping=True)
+        return encoded["offset_mapping"]
+
+    def _chunk_texts(self, texts, first_topic_id, chunk_tokens=DEFAULT_CHUNK_TOKENS,
+                     chunk_overlap=DEFAULT_CHUNK_OVERLAP, min_chunk_tokens=DEFAULT_MIN_CHUNK_TOKENS,
+                     source="User Input"):
+        """
+        Split texts into CLIP-token windows stored as metadata entries, one article per text.
+
+        Every chunk fits in CLIP's context, so its embedding covers exactly the stored content.
+        Texts shorter than `min_chunk_tokens` are dropped.
+
+        Parameters:
+        - texts: List of texts; text i becomes article first_topic_id + i.
+        - chunk_tokens: Token budget per chunk (at most 75 for CLIP).
+        - chunk_overlap: Tokens shared by consecutive chunks of the same text.
+        - min_chunk_tokens: Smallest text worth indexing.
+        - source: Value of the "source" field of the entries.
+
+        Returns:
+        - (entries, stats) with stats counting texts, chunks, tokens, embedded_tokens,
+          dropped_chunks and dropped_tokens.
+        """
+        stats = empty_chunk_stats()
+        entries = []
+        for text_idx, (text, offsets) in enumerate(zip(texts, self._token_offsets(texts))):
+            stats["texts"] += 1
+            stats["tokens"] += len(offsets)
+            if len(offsets) < min_chunk_tokens:
+                if offsets:
+                    stats["dropped_chunks"] += 1
+                    stats["dropped_tokens"] += len(offsets)
+                continue
+            words = text.split()
+            title = text[:MAX_TITLE_CHARS].split(".")[0]  # Use the first sentence as the title
+            summary = " ".join(words[:20])  # First 20 words as a summary
+            for sub_idx, (first, end) in enumerate(token_windows(offsets, chunk_tokens, chunk_overlap), start=1):
+                stats["chunks"] += 1
+                stats["embedded_tokens"] += end - first
+                entries.append({
+                    "type": "text",
+                    "ID": f"{first_topic_id + text_idx}.{sub_idx}",
+                    "title": title,
+                    "summary": summary,
+                    "content": text[offsets[first][0]:offsets[end - 1][1]],
+                    "source": source,
+                })
+
+        # Re-tokenizing a cut-out span can merge tokens differently at its edges; make sure the
+        # stored content really fits the window the embedding sees
+        if entries:
+            contents = [entry["content"] for entry in entries]
+            for entry, offsets in zip(entries, self._token_offsets(contents)):
+                if len(offsets) > chunk_tokens:
+                    entry["content"] = entry["content"][:offsets[chunk_tokens - 1][1]]
+                    stats["dropped_tokens"] += len(offsets) - chunk_tokens
+        return entries, stats
+
+    @staticmethod
+    def _print_chunk_stats(stats):
+        print(f"Chunked {stats['texts']} texts ({stats['tokens']} tokens) into {stats['chunks']} chunks "
+              f"({stats['embedded_tokens']} tokens embedded incl. overlap); dropped {stats['dropped_chunks']} "
+              f"texts below the minimum and {stats['dropped_tokens']} tokens")
+
+    def ingest_text_file(self, file_path, commit_size=1024, chunk_tokens=DEFAULT_CHUNK_TOKENS,
+                         chunk_overlap=DEFAULT_CHUNK_OVERLAP, min_chunk_tokens=DEFAULT_MIN_CHUNK_TOKENS,
+                         source="User Input", resume=True, progress_callback=None, dedup_threshold=None):
+        """
+        Stream a (possibly multi-gigabyte) text file into the knowledge base.
+
+        Paragraphs are read, chunked, encoded and committed as delta segments in batches of about
+        `commit_size` chunks, so memory stays flat regardless of the file size. After every batch
+        the consumed byte offset is checkpointed in "<file_path>.ingest.json"; an interrupted run
+        started again resumes after the last committed batch.
+
+        Parameters:
+        - file_path: Path to the UTF-8 text file; paragraphs are separated by blank lines.
+        - commit_size: Chunks encoded and committed per batch.
+        - chunk_tokens, chunk_overlap, min_chunk_tokens: CLIP-token chunking as in add_new_data.
+        - source: Value of the "source" field of the new entries.
+        - resume: Continue from the checkpoint if there is one (False starts over).
+        - progress_callback: Optional callable(bytes_done, bytes_total, rows_added) per batch.
+        - dedup_threshold: Near-duplicate similarity threshold (defaults to self.dedup_threshold).
+
+        Returns:
+        - Chunking stats of this call (see _chunk_texts) plus "added", "duplicates_exact" and
+          "duplicates_near".
+        """
+        stats = merge_chunk_stats(empty_chunk_stats(), {"added": 0, "duplicates_exact": 0, "duplicates_near": 0})
+        if not os.path.exists(file_path):
+            print(f"Error: File {file_path} not found.")
+            return stats
+        if self._has_unindexed_rows():
+            print("Error: the metadata has not been indexed yet; run create_new_index before adding data.")
+            return stats
+
+        checkpoint = checkpoint_path_for(file_path)
+        offset = load_checkpoint(checkpoint, len(self.metadata)) if resume else 0
+        total_bytes = os.path.getsize(file_path)
+        if offset:
+            print(f"Resuming {file_path} at byte {offset}/{total_bytes}")
+
+        added = 0
+        entries = []
+        paragraphs = []
+        end_offset = offset
+        topic_id = self._next_article_id()
+
+        def chunk_paragraphs():
+            nonlocal paragraphs, topic_id
+            new_entries, new_stats = self._chunk_texts(paragraphs, topic_id, chunk_tokens, chunk_overlap,
+                                                       min_chunk_tokens, source)
+            entries.extend(new_entries)
+            merge_chunk_stats(stats, new_stats)
+            topic_id += len(paragraphs)
+            paragraphs = []
+
+        def commit():
+            nonlocal added, entries, offset
+            embeddings = self._encode_texts_cached([entry["content"] for entry in entries])
+            keep, report = self._find_duplicates(embeddings, entries, dedup_threshold)
+            self._print_dedup_report(report, entries)
+            stats["duplicates_exact"] += report["exact"]
+            stats["duplicates_near"] += report["near"]
+            rows = len(self.metadata)
+            save_checkpoint(checkpoint, offset, rows, pending={"offset": end_offset, "rows": rows + len(keep)})
+            if keep:
+                self._append_entries(embeddings[keep], [entries[i] for i in keep])
+            save_checkpoint(checkpoint, end_offset, len(self.metadata))
+            added += len(keep)
+            stats["added"] = added
+            entries = []
+            offset = end_offset
+            if progress_callback:
+                progress_callback(offset, total_bytes, added)
+
+        # Paragraphs are tokenized in groups; batches end on paragraph boundaries so the
+        # checkpoint offset is always a safe restart point
+        for paragraph, end_offset in iter_paragraphs(file_path, start_offset=offset):
+            paragraphs.append(paragraph)
+            if len(paragraphs) >= TOKENIZE_BATCH_SIZE:
+                chunk_paragraphs()
+                if len(entries) >= commit_size:
+                    commit()
+        if paragraphs:
+            chunk_paragraphs()
+        if entries:
+            commit()
+        elif end_offset != offset:
+            # Trailing paragraphs too short to keep
+            save_checkpoint(checkpoint, end_offset, len(self.metadata))
+        self._print_chunk_stats(stats)
+        return stats
+
+    def _append_entries(self, embeddings, entries):
+        """
+        Append embeddings and their metadata rows, keeping the derived lookup structures current.
+
+        The rows are first written as an append-only delta segment (atomically), so a crash can
+        never leave the index and metadata out of sync; query searches the delta index alongside
+        the main one until the next compaction.
+        """
+        with self._writing(), self._lock:
+            first_row = len(self.metadata)
+            if self._has_unindexed_rows():
+                # Raised rather than reported so that callers (e.g. a checkpointing ingestion)
+                # never treat the rows as stored
+                raise RuntimeError("The metadata has not been indexed yet; run create_new_index before adding data.")
+            for entry in entries:
+                if entry.get("uid") is None:
+                    entry["uid"] = self._next_uid
+                    self._next_uid += 1
+            write_segment(self._delta_dir(), first_row, embeddings, entries)
+            self.delta_index.add(embeddings)
+            self.metadata.extend(entries)
+            self._row_uids = np.concatenate([self._row_uids, [entry["uid"] for entry in entries]]).astype(np.int64)
+            self._dead_rows = np.concatenate([self._dead_rows, np.zeros(len(entries), dtype=bool)])
+            if self._content_hashes is not None:
+                self._content_hashes.update(filter(None, map(self._content_key, entries)))
+            if self._lexical_index is not None:
+                for row, entry in enumerate(entries, start=first_row):
+                    self._add_lexical_row(row, entry)
+            self._update_attribute_index(first_row, entries)
+            self._result_cache.clear()
+            for row, entry in enumerate(entries, start=first_row):
+                if entry.get("type") == "text":
+                    self._add_article_chunk(row, entry["ID"])
+            self.file_signature = self._current_file_signature()
+        self._maybe_compact()
+
+    def update_entry(self, uid, **fields):
+        """
+        Change one entry in place of a rebuild, keeping its stable ID.
+
+        The new version is appended as a delta row carrying the same ID, and the old row is
+        hidden from search. Only this entry is re-encoded, and only if its content or image
+        changed; otherwise its stored vector is reused.
+
+        Parameters:
+        - uid: Stable ID of the entry (see entry_ids).
+        - fields: Metadata fields to set, e.g. content="...", title="...", source="...".
+
+        Returns:
+        - Metadata row of the new version.
+        """
+        if "uid" in fields:
+            raise ValueError("The id of an entry cannot be changed.")
+        with self._writing(), self._lock:
+            row = self._live_row(uid)
+            entry = {**self.metadata[row], **fields, "uid": int(uid)}
+            if entry.get("type") == "text" and "content" in fields:
+                embedding = self._encode_texts_cached([entry["content"]])
+            elif entry.get("type") == "image" and "image_path" in fields:
+                embedding = self._encode_images_cached(image_paths=[entry["image_path"]])
+            else:
+                embedding = self._stored_vector(row)[None, :]
+            self._kill_rows([row])
+            self._append_entries(embedding.astype(np.float32), [entry])
+            return len(self.metadata) - 1
+
+    def delete_entries(self, uids):
+        """
+        Delete entries by stable ID without a rebuild.
+
+        The IDs are recorded in the ids file next to the index and their rows are excluded from
+        every search right away; the vectors are dropped for good by the next create_new_index.
+
+        Parameters:
+        - uids: Iterable of stable IDs.
+
+        Returns:
+        - Number of entries deleted (unknown or already deleted IDs are reported and skipped).
+        """
+        with self._writing(), self._lock:
+            rows = []
+            for uid in uids:
+                try:
+                    rows.append(self._live_row(uid))
+                except ValueError as e:
+                    print(f"Error: {e}")
+                    continue
+                self._deleted_uids.add(int(uid))
+            if rows:
+                self._save_ids()
+                self._kill_rows(rows)
+                self.file_signature = self._current_file_signature()
+            return len(rows)
+
+    def _stored_vector(self, row):
+        """
+        The vector stored for one metadata row (exact for quantized indexes with a side file).
+        """
+        main_rows = self._main_rows()
+        if row >= main_rows:
+            return self.delta_index.reconstruct(int(row - main_rows))
+        if self.full_vectors is not None:
+            return np.array(self.full_vectors[row])
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+            ivf.make_direct_map()
+        return self.index.reconstruct(int(row))
+
+    def check_consistency(self, sample=50, min_similarity=None, seed=0):
+        """
+        Check that the index and the metadata line up.
+
+        Counts are compared (index + delta rows vs metadata rows, quantized side file rows,
+        ids file), then `sample` random live entries are re-encoded and compared with the vector
+        stored at their row, which catches metadata and index rows that went out of order.
+
+        Parameters:
+        - sample: Live entries to re-encode (0 to only compare counts).
+        - min_similarity: Cosine below which a row is reported (default 0.99, or 0.9 for a
+          quantized index without exact vectors).
+
+        Returns:
+        - Dict with ok, rows, index_rows, delta_rows, live_rows, deleted, superseded, checked,
+          mismatched (rows) and issues (messages).
+        """
+        with self._lock:
+            main_rows, delta_rows = self._main_rows(), self.delta_index.ntotal
+            issues = []
+            if main_rows + delta_rows != len(self.metadata):
+                issues.append(f"index has {main_rows} + {delta_rows} delta vectors but metadata has "
+                              f"{len(self.metadata)} rows")
+            quantized = self.index is not None and self.index_params["index_type"] in QUANTIZED_INDEX_TYPES
+            if quantized and self.full_vectors is None:
+                issues.append(f"exact vectors file {self._vectors_path()} is missing or shorter than the index")
+            missing = [uid for uid in self._deleted_uids if not (self._row_uids == uid).any()]
+            if missing:
+                issues.append(f"{len(missing)} deleted ids are not in the metadata")
+            deleted = int(np.isin(self._row_uids, list(self._deleted_uids)).sum()) if self._deleted_uids else 0
+            superseded = int(self._dead_rows.sum()) - deleted
+
+            if min_similarity is None:
+                min_similarity = 0.9 if quantized and self.full_vectors is None else 0.99
+            live = np.flatnonzero(~self._dead_rows[:main_rows + delta_rows])
+            rng = np.random.default_rng(seed)
+            rows = rng.choice(live, size=min(sample, len(live)), replace=False) if sample else []
+            entries = [(int(row), self.metadata[int(row)]) for row in sorted(rows)]
+            stored = {row: self._stored_vector(row) for row, _ in entries}
+
+        mismatched = []
+        texts = [(row, entry["content"]) for row, entry in entries if entry.get("type") == "text"]
+        images = [(row, entry["image_path"]) for row, entry in entries
+                  if entry.get("type") == "image" and not self.text_only and os.path.exists(entry["image_path"])]
+        encoded = []
+        if texts:
+            encoded += zip([row for row, _ in texts], self._encode_texts_cached([text for _, text in texts]))
+        if images:
+            encoded += zip([row for row, _ in images], self._encode_images_cached(image_paths=[path for _, path in images]))
+        for row, embedding in encoded:
+            similarity = float(np.dot(embedding, stored[row]) / (np.linalg.norm(stored[row]) or 1.0))
+            if similarity < min_similarity:
+                mismatched.append(row)
+        if mismatched:
+            issues.append(f"{len(mismatched)} of {len(encoded)} sampled rows do not match their stored vector "
+                          f"(first: {mismatched[:5]})")
+
+        report = {
+            "ok": not issues, "rows": len(self.metadata), "index_rows": main_rows, "delta_rows": delta_rows,
+            "live_rows": len(live), "deleted": deleted, "superseded": superseded, "checked": len(encoded),
+            "mismatched": mismatched, "issues": issues,
+        }
+        print(f"Consistency: {report['rows']} rows ({main_rows} indexed + {delta_rows} delta, {len(live)} live, "
+              f"{deleted} deleted, {superseded} superseded); {len(encoded)} sampled rows re-encoded")
+        for issue in issues:
+            print(f"Error: {issue}")
+        if not issues:
+            print("Index and metadata are consistent.")
+        return report
+
+    @staticmethod
+    def _content_key(entry):
+        """
+        Hash of a text entry's content with case and whitespace normalized (None for images).
+        """
+        if entry.get("type") != "text" or not entry.get("content"):
+            return None
+        return hashlib.sha256(" ".join(entry["content"].lower().split()).encode("utf-8")).hexdigest()
+
+    def _ensure_content_hashes(self):
+        if self._content_hashes is None:
+            self._content_hashes = {
+                self._content_key({"type": "text", "content": content})
+                for row, content in field_values(self.metadata, "content") if content and not self._dead_rows[row]
+            }
+        return self._content_hashes
+
+    def _find_duplicates(self, embeddings, entries, threshold=None):
+        """
+        Decide which new entries are worth indexing.
+
+        An entry is skipped when its normalized text is already in the knowledge base (exact),
+        or when its embedding is within `threshold` cosine similarity of an indexed entry of the
+        same type, or of an earlier entry of the same batch (near-duplicate).
+
+        Parameters:
+        - embeddings: (n, dim) normalized embeddings of the entries.
+        - entries: The n metadata entries.
+        - threshold: Cosine similarity threshold (defaults to self.dedup_threshold; None disables
+          the embedding check).
+
+        Returns:
+        - (keep, report): positions of the entries to add, and a dict with "checked", "exact",
+          "near" counts and "skipped" details (position, reason, matched row or position, similarity).
+        """
+        threshold = self.dedup_threshold if threshold is None else threshold
+        report = {"checked": len(entries), "exact": 0, "near": 0, "skipped": []}
+        with self._lock:
+            known = self._ensure_content_hashes()
+
+        # Nearest indexed neighbour of every entry, searched among rows of the same type.
+        # Normalized vectors: cosine similarity = 1 - squared L2 distance / 2.
+        nearest_rows = np.full(len(entries), -1, dtype=np.int64)
+        nearest_sims = np.full(len(entries), -np.inf, dtype=np.float32)
+        if threshold is not None:
+            for entry_type in {entry.get("type") for entry in entries}:
+                positions = [i for i, entry in enumerate(entries) if entry.get("type") == entry_type]
+                distances, indices = self._search(embeddings[positions], 1, filters={"type": entry_type})
+                nearest_rows[positions] = indices[:, 0]
+                nearest_sims[positions] = np.where(indices[:, 0] >= 0, 1 - distances[:, 0] / 2, -np.inf)
+
+        keep = []
+        batch_keys = set()
+        for position, entry in enumerate(entries):
+            key = self._content_key(entry)
+            if key is not None and (key in known or key in batch_keys):
+                report["exact"] += 1
+                report["skipped"].append((position, "exact", None, 1.0))
+                continue
+            if threshold is not None:
+                if nearest_sims[position] >= threshold:
+                    report["near"] += 1
+                    report["skipped"].append((position, "near", int(nearest_rows[position]), float(nearest_sims[position])))
+                    continue
+                same_type = [kept for kept in keep if entries[kept].get("type") == entry.get("type")]
+                if same_type:
+                    sims = embeddings[same_type] @ embeddings[position]
+                    best = int(np.argmax(sims))
+                    if sims[best] >= threshold:
+                        report["near"] += 1
+                        report["skipped"].append((position, "near-batch", same_type[best], float(sims[best])))
+                        continue
+            keep.append(position)
+            if key is not None:
+                batch_keys.add(key)
+        return keep, report
+
+    def _print_dedup_report(self, report, entries, limit=10):
+        if not report["exact"] and not report["near"]:
+            return
+        print(f"Skipped {report['exact']} exact and {report['near']} near-duplicates out of {report['checked']} new entries")
+        def label(entry):
+            return entry.get("image_path") or entry.get("title") or entry.get("ID")
+
+        for position, reason, match, similarity in report["skipped"][:limit]:
+            if reason == "near":
+                print(f"  {label(entries[position])!r}: similarity {similarity:.3f} to indexed row {match} "
+                      f"({label(self.metadata[match])!r})")
+            elif reason == "near-batch":
+                print(f"  {label(entries[position])!r}: similarity {similarity:.3f} to new entry {label(entries[match])!r}")
+            else:
+                print(f"  {label(entries[position])!r}: exact duplicate")
+        if len(report["skipped"]) > limit:
+            print(f"  ... and {len(report['skipped']) - limit} more")
+
+    def _maybe_compact(self):
+        if self.compact_threshold is None or self.delta_index.ntotal < self.compact_threshold:
+            return
+        if self._compaction_thread is None or not self._compaction_thread.is_alive():
+            self.compact(background=True)
+
+    def compact(self, background=False, force=False):
+        """
+        Merge the delta segments into the main index and publish it.
+
+        Metadata is written first and the index last, each with write-then-rename, so the index
+        file is the commit point: if the process dies midway, the next load replays the segments
+        that are still on disk. Queries keep running during the merge; writers wait for it.
+
+        Parameters:
+        - background: Run in a separate thread and return it.
+        - force: Rewrite index and metadata even if there are no pending delta rows.
+        """
+        if background:
+            self._compaction_thread = threading.Thread(target=self.compact, kwargs={"force": force},
+                                                       name="rag-compaction")
+            self._compaction_thread.start()
+            return self._compaction_thread
+
+        with self._compaction_lock, self._writing():
+            with self._lock:
+                main_index, main_rows = self.index, self._main_rows()
+                delta_rows = self.delta_index.ntotal
+                if not delta_rows and (not force or main_index is None):
+                    return None
+                has_full_vectors = self.full_vectors is not None
+                delta_vectors = self.delta_index.reconstruct_n(0, delta_rows) if delta_rows else None
+                # The JSON backend rewrites the whole list, the SQLite one already holds the rows
+                metadata_snapshot = self.metadata[:main_rows + delta_rows] if isinstance(self.metadata, list) else self.metadata
+
+            start = time.perf_counter()
+            if main_index is None:
+                new_index = self._build_faiss_index(delta_vectors, self.index_params)
+                self._apply_search_params(new_index, self.index_params)
+            else:
+                new_index = self._writable_copy(main_index)
+                if new_index is None:
+                    return None
+                if delta_rows:
+                    new_index.add(delta_vectors)
+            save_metadata(metadata_snapshot, self.metadata_path)
+            if self.index_params["index_type"] in QUANTIZED_INDEX_TYPES:
+                if main_index is None:
+                    write_vectors_file(self._vectors_path(), delta_vectors)
+                elif has_full_vectors and delta_rows:
+                    append_vectors_file(self._vectors_path(), main_rows, delta_vectors)
+            atomic_write_index(new_index, self.index_path)
+            if self.mmap_index:
+                new_index = self._load_faiss_index(self.index_path, True, self.index_params["index_type"])
+                self._apply_search_params(new_index, self.index_params)
+
+            with self._lock:
+                # Rows appended while we were merging stay in a fresh delta index
+                new_delta = faiss.IndexFlatL2(new_index.d)
+                pending = self.delta_index.ntotal - delta_rows
+                if pending:
+                    new_delta.add(self.delta_index.reconstruct_n(delta_rows, pending))
+                self.index, self.delta_index = new_index, new_delta
+                self.full_vectors = self._open_full_vectors(new_index, self.index_params)
+                self._selector_cache = {}
+                for base_row, count, path in list_segments(self._delta_dir()):
+                    if base_row + count <= main_rows + delta_rows:
+                        os.remove(path)
+                self.file_signature = self._current_file_signature()
+            print(f"Compacted {delta_rows} delta rows into the main index ({new_index.ntotal} rows) "
+                  f"in {time.perf_counter() - start:.2f}s")
+            return new_index.ntotal
+
+    def _writable_copy(self, index):
+        """
+        A private copy of the main index that vectors can be added to. Memory-mapped indexes
+        cannot be cloned or grown, so they are read again from their file.
+        """
+        if not self.mmap_index:
+            return faiss.clone_index(index)
+        copy = faiss.read_index(self.index_path)
+        if copy.ntotal != index.ntotal:
+            print(f"Error: {self.index_path} changed on disk ({copy.ntotal} vectors, {index.ntotal} loaded); "
+                  f"reload before compacting.")
+            return None
+        self._apply_search_params(copy, self.index_params)
+        return copy
 
     def add_images(self, img_dir=None, database_dir=None):
         """
@@ -264,14 +2362,15 @@ class RAGEngine:
         for filename in os.listdir(img_dir):
             file_path = os.path.join(img_dir, filename)
 
-            if file_path.lower().endswith(('.png', '.jpg', '.jpeg')):
+            if file_path.lower().endswith(IMAGE_EXTENSIONS):
                 try:
                     # Move image to the database folder
                     img = Image.open(file_path).convert("RGB")
-                    imgs.append(img)
                     new_path = os.path.join(database_dir, filename)
                     shutil.move(file_path, new_path)
                     #new_images = [Image.open("/path/to/new_image1.jpg").convert("RGB"), Image.open("/path/to/new_image2.jpg").convert("RGB")]
+                    # Only images that reached the database folder, so imgs and image_paths stay aligned
+                    imgs.append(img)
                     image_paths.append(new_path)
                 except Exception as e:
                     print(f"Error processing image {file_path}: {e}")
@@ -304,28 +2403,276 @@ class RAGEngine:
 
     def save(self):
         """
-        Save the FAISS index and metadata.
+        Save the FAISS index and metadata: compacts any delta segments and atomically rewrites both.
         """
-        faiss.write_index(self.index, self.index_path)
-        with open(self.metadata_path, "w", encoding="utf-8") as f:
-            json.dump(self.metadata, f, indent=4)
+        self.compact(force=True)
+
+
+def _file_identity(path):
+    """
+    (inode, size, mtime_ns) of a file, or None if it is missing. A file replaced by rename gets
+    a new inode, so this tells the replaced index file from its successor.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+def _file_signature(*paths):
+    """
+    Cheap change detector for on-disk files: (mtime_ns, size) per path, None if missing.
+    """
+    signature = []
+    for path in paths:
+        if path and os.path.exists(path):
+            stat = os.stat(path)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        else:
+            signature.append(None)
+    return tuple(signature)
+
+
+# Process-wide engine registry. Streamlit re-executes app.py on every rerun and
+# runs each browser session in its own thread, but imported modules are only
+# loaded once per process, so engines stored here are shared by all of them.
+_ENGINE_REGISTRY = {}
+_ENGINE_REGISTRY_LOCK = threading.Lock()
+
+
+def _load_clip(model_name, text_only=False):
+    """
+    Load the CLIP model and processor. transformers (and torch with it) is imported here, on
+    first use, rather than when this module is imported.
+
+    Returns:
+    - (model, processor); the model is CLIPTextModelWithProjection when text_only is set.
+    """
+    from transformers import CLIPModel, CLIPProcessor
+
+    if text_only:
+        from transformers import CLIPTextModelWithProjection
+        model = CLIPTextModelWithProjection.from_pretrained(model_name)
+    else:
+        model = CLIPModel.from_pretrained(model_name)
+    return model, CLIPProcessor.from_pretrained(model_name)
+
+
+def _process_memory_mb():
+    """
+    Resident memory of this process in MiB, and how much of it is file-backed pages that other
+    processes mapping the same files (e.g. a memory-mapped index) share (peak RSS and None where
+    /proc is not available).
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            fields = f.read().split()
+        page_mb = os.sysconf("SC_PAGE_SIZE") / 2**20
+        return int(fields[1]) * page_mb, int(fields[2]) * page_mb
+    except (OSError, ValueError, AttributeError):
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return (peak / 2**20 if sys.platform == "darwin" else peak / 1024), None
+
+
+def _rss_mb():
+    return _process_memory_mb()[0]
+
+
+def get_rag_engine(index_path, metadata_path, clip_model_name=DEFAULT_CLIP_MODEL, text_only=False, mmap_index=False):
+    """
+    Return the shared RAGEngine for (index_path, metadata_path, clip_model_name, text_only, mmap_index).
+
+    The engine is loaded once per process and reused by every caller. If the index
+    or metadata file changed on disk since it was loaded, the index and metadata
+    are re-read in place (the CLIP model is kept).
+
+    Parameters:
+    - index_path: Path to the FAISS index file.
+    - metadata_path: Path to the metadata file (JSON list, or a .sqlite/.db SQLite store).
+    - clip_model_name: Hugging Face name of the CLIP model.
+    - text_only: Load only the text tower (see RAGEngine).
+    - mmap_index: Memory-map the index file (see RAGEngine), sharing it with other processes.
+
+    Returns:
+    - The shared RAGEngine instance.
+    """
+    key = (os.path.abspath(index_path), os.path.abspath(metadata_path), clip_model_name, text_only, mmap_index)
+    with _ENGINE_REGISTRY_LOCK:
+        entry = _ENGINE_REGISTRY.get(key)
+        if entry is not None and not entry["engine"].changed_on_disk():
+            entry["reuses"] += 1
+            return entry["engine"]
+
+        start = time.perf_counter()
+        rss_before = _rss_mb()
+        if entry is None:
+            engine = RAGEngine(index_path, metadata_path, clip_model_name=clip_model_name, text_only=text_only,
+                               mmap_index=mmap_index)
+            entry = {"engine": engine, "loads": 1, "reloads": 0, "reuses": 0, "total_load_seconds": 0.0}
+            _ENGINE_REGISTRY[key] = entry
+            action = "Loaded"
+        else:
+            entry["engine"].reload()
+            entry["reloads"] += 1
+            action = "Reloaded (files changed on disk)"
+        entry["last_load_seconds"] = time.perf_counter() - start
+        entry["total_load_seconds"] += entry["last_load_seconds"]
+        entry["rss_mb"], entry["shared_mb"] = _process_memory_mb()
+        entry["load_rss_delta_mb"] = entry["rss_mb"] - rss_before
+        shared = f", {entry['shared_mb']:.0f} MiB shared" if entry["shared_mb"] is not None else ""
+        print(f"[RAG] {action} engine for {index_path} in {entry['last_load_seconds']:.2f}s "
+              f"(RSS {entry['rss_mb']:.0f} MiB{shared}, +{entry['load_rss_delta_mb']:.0f} MiB)")
+        return entry["engine"]
+
 
+def rag_engine_stats():
+    """
+    Load time and reuse counters for every engine in the shared registry.
+
+    Returns:
+    - List of dicts with index_path, metadata_path, clip_model_name, text_only, mmap_index, loads,
+      reloads, reuses, last_load_seconds, total_load_seconds, rss_mb and shared_mb (at load time),
+      and the current process_rss_mb and process_shared_mb.
+    """
+    process_rss_mb, process_shared_mb = _process_memory_mb()
+    with _ENGINE_REGISTRY_LOCK:
+        return [
+            {
+                "index_path": key[0],
+                "metadata_path": key[1],
+                "clip_model_name": key[2],
+                "text_only": key[3],
+                "mmap_index": key[4],
+                **{name: value for name, value in entry.items() if name != "engine"},
+                "query_cache": entry["engine"].cache_stats(),
+                "process_rss_mb": process_rss_mb,
+                "process_shared_mb": process_shared_mb,
+            }
+            for key, entry in _ENGINE_REGISTRY.items()
+        ]
+
+# Measured in a fresh interpreter per scenario, so imports and model loading start cold
+_STARTUP_PROBE = """
+import json, os, sys, time
+start = time.perf_counter()
+for module in sys.argv[4].split(",") if sys.argv[4] else []:
+    __import__(module)
+import RAG
+imported = time.perf_counter()
+rss_imported = RAG._rss_mb()
+engine = RAG.RAGEngine(sys.argv[1], sys.argv[2], text_only=sys.argv[3] == "1", mmap_index=sys.argv[5] == "1")
+loaded = time.perf_counter()
+rss, shared = RAG._process_memory_mb()
+print(json.dumps({"import_seconds": imported - start, "engine_seconds": loaded - imported,
+                  "total_seconds": loaded - start, "rss_after_import_mb": rss_imported, "rss_mb": rss,
+                  "shared_mb": shared}))
+"""
+
+# What importing RAG used to pull in unconditionally
+_LEGACY_EAGER_IMPORTS = "sentence_transformers,matplotlib.pyplot,transformers,torch"
+
+
+def startup_report(index_path, metadata_path):
+    """
+    Measure cold start time and resident memory of the RAG engine.
+
+    Each scenario runs in its own interpreter: the previous behaviour (eager imports of
+    sentence_transformers, matplotlib, transformers and torch plus the full CLIP model), the
+    full model with deferred imports, the text-only mode, and text-only with the index
+    memory-mapped as used by the app.
+
+    Returns:
+    - Dict of scenario -> {"import_seconds", "engine_seconds", "total_seconds",
+      "rss_after_import_mb", "rss_mb", "shared_mb"}.
+    """
+    import subprocess
+    import sys
+
+    scenarios = {
+        "eager imports + full CLIP (before)": ("0", _LEGACY_EAGER_IMPORTS, "0"),
+        "lazy imports + full CLIP": ("0", "", "0"),
+        "lazy imports + text tower only": ("1", "", "0"),
+        "lazy imports + text tower + mmap index": ("1", "", "1"),
+    }
+    report = {}
+    for name, (text_only, preload, mmap_index) in scenarios.items():
+        result = subprocess.run(
+            [sys.executable, "-c", _STARTUP_PROBE, index_path, metadata_path, text_only, preload, mmap_index],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            print(f"{name}: failed\n{result.stderr.strip()}")
+            continue
+        report[name] = json.loads(result.stdout.strip().splitlines()[-1])
+        r = report[name]
+        print(f"{name}: import {r['import_seconds']:.2f}s, engine {r['engine_seconds']:.2f}s, "
+              f"total {r['total_seconds']:.2f}s; RSS {r['rss_after_import_mb']:.0f} MiB after import, "
+              f"{r['rss_mb']:.0f} MiB loaded ({r['shared_mb'] or 0:.0f} MiB shared)")
+    return report
 
 
 def main():
     # Set up argument parser
     parser = argparse.ArgumentParser(description="Run RAGEngine with FAISS index and metadata.")
     parser.add_argument("--index_path", type=str, required=True, help="Path to the FAISS index file.")
-    parser.add_argument("--metadata_path", type=str, required=True, help="Path to the metadata JSON file.")
+    parser.add_argument("--metadata_path", type=str, required=True, help="Path to the metadata file (.json, or .sqlite/.db for the SQLite store).")
+    parser.add_argument("--migrate_metadata", type=str, required=False, help="Convert the metadata JSON file into a SQLite store at this path and exit.")
     parser.add_argument("--text_query", type=str, required=False, help="Please provide the text_query for retrieval")
     parser.add_argument("--new_text_file", type=str, required=False, help="Path to the text file to add new data. (.txt file)")
+    parser.add_argument("--ingest_batch_size", type=int, default=1024, help="Text chunks encoded and committed per batch when streaming --new_text_file.")
+    parser.add_argument("--chunk_tokens", type=int, default=DEFAULT_CHUNK_TOKENS, help="CLIP tokens per text chunk (at most 75).")
+    parser.add_argument("--chunk_overlap", type=int, default=DEFAULT_CHUNK_OVERLAP, help="CLIP tokens shared by consecutive chunks.")
+    parser.add_argument("--restart_ingest", action="store_true", help="Ignore the checkpoint of --new_text_file and ingest it from the start.")
     parser.add_argument("--new_img_dir", type=str, required=False, help="Path to a directory containing new images.")
     parser.add_argument("--database_dir", type=str, required=False, help="Path to the existing image database where new images will be stored.")
+    parser.add_argument("--dedup_threshold", type=float, default=DEFAULT_DEDUP_THRESHOLD, help="Cosine similarity at which new texts/images are skipped as near-duplicates of indexed ones (above 1 keeps everything except exact text duplicates).")
+    parser.add_argument("--inference_backend", type=str, choices=BACKENDS, default=DEFAULT_BACKEND, help="How CLIP is run: PyTorch, PyTorch with dynamic int8 quantization, or an exported ONNX graph.")
+    parser.add_argument("--num_threads", type=int, required=False, help="CPU threads used for CLIP inference.")
+    parser.add_argument("--text_only", action="store_true", help="Load only CLIP's text tower (no image queries or image ingestion).")
+    parser.add_argument("--mmap_index", action="store_true", help="Memory-map the index file instead of reading it into memory (shared between processes).")
+    parser.add_argument("--startup_report", action="store_true", help="Measure cold start time and memory with eager imports, lazy imports, and text-only mode, and exit.")
+    parser.add_argument("--benchmark_backends", action="store_true", help="Time every inference backend against the current PyTorch path, report embedding agreement, and exit.")
+    parser.add_argument("--image_workers", type=int, required=False, help="Threads decoding images for --new_img_dir (default: CPU count, at most 8).")
+    parser.add_argument("--rebuild_index", action="store_true", help="Re-encode all metadata entries and rebuild the FAISS index.")
+    parser.add_argument("--rebuild_workers", type=int, required=False, help="Rebuild with this many worker processes, checkpointing every shard so an interrupted rebuild resumes.")
+    parser.add_argument("--shard_size", type=int, default=DEFAULT_SHARD_SIZE, help="Items per checkpointed shard with --rebuild_workers.")
+    parser.add_argument("--compact", action="store_true", help="Merge pending delta segments into the main index.")
+    parser.add_argument("--delete_ids", type=int, nargs="+", required=False, help="Delete entries by their stable id (see RAGEngine.entry_ids).")
+    parser.add_argument("--check_consistency", action="store_true", help="Check that the index and the metadata line up, re-encoding a sample of entries.")
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_ENCODE_BATCH_SIZE, help="Number of texts/images encoded per CLIP forward pass.")
+    parser.add_argument("--embedding_cache_dir", type=str, required=False, help="Directory of the persistent embedding cache; only new or changed content is re-encoded.")
+    parser.add_argument("--index_type", type=str, choices=INDEX_TYPES, required=False, help="Index type to build with --rebuild_index (default: keep the stored type).")
+    parser.add_argument("--nlist", type=int, required=False, help="IVF: number of clusters (build time).")
+    parser.add_argument("--nprobe", type=int, required=False, help="IVF: clusters searched per query.")
+    parser.add_argument("--hnsw_m", type=int, required=False, help="HNSW: neighbours per node (build time).")
+    parser.add_argument("--ef_search", type=int, required=False, help="HNSW: search depth per query.")
+    parser.add_argument("--pq_m", type=int, required=False, help="PQ: number of sub-quantizers (must divide the embedding size).")
+    parser.add_argument("--rerank_factor", type=int, required=False, help="sq8/fp16/pq: candidates re-ranked with exact vectors per requested result.")
+    parser.add_argument("--recall_k", type=int, required=False, help="Report recall@k of the index against exact flat search.")
+    parser.add_argument("--retrieval_mode", type=str, choices=("chunk", "neighbors", "article"), default="chunk", help="Return matched chunks, chunks with their neighbours, or whole articles.")
+    parser.add_argument("--article_token_budget", type=int, required=False, help="Maximum CLIP tokens per result in neighbors/article mode.")
+    parser.add_argument("--search_mode", type=str, choices=SEARCH_MODES, default="dense", help="Dense CLIP search, BM25 keyword search, or both fused.")
+    parser.add_argument("--lexical_prefilter", action="store_true", help="Restrict the dense search to the best BM25 keyword matches.")
+    parser.add_argument("--serve", action="store_true", help="Run as a shared retrieval service for the app (see --serve_address).")
+    parser.add_argument("--serve_address", type=str, default="tcp://127.0.0.1:5560", help="ZeroMQ address the service binds to.")
+    parser.add_argument("--batch_window_ms", type=float, default=5, help="Service: how long to wait for more queries to batch with the first one.")
+    parser.add_argument("--max_batch_size", type=int, default=32, help="Service: most queries encoded and searched together.")
 
     args = parser.parse_args()
     #print(args)
+    if args.migrate_metadata:
+        try:
+            migrated = migrate_json_to_sqlite(args.metadata_path, args.migrate_metadata)
+        except (OSError, ValueError) as e:
+            print(e)
+            return
+        print(f"Migrated {migrated} metadata rows to {args.migrate_metadata}")
+        return
+
     # Check if index and metadata paths exist
-    if not os.path.exists(args.index_path):
+    if not os.path.exists(args.index_path) and not args.rebuild_index:
         print(f"Error: Index file not found at {args.index_path}")
         return
     if not os.path.exists(args.metadata_path):
@@ -340,40 +2687,110 @@ def main():
             os.makedirs(args.database_dir, exist_ok=True)  # Create the directory
             print(f"Database directory created at {args.database_dir}")
 
+    if args.startup_report:
+        startup_report(args.index_path, args.metadata_path)
+        return
+
     # Initialize RAGEngine
-    engine = RAGEngine(index_path=args.index_path, metadata_path=args.metadata_path)
+    index_params = {
+        name: value
+        for name, value in (("index_type", args.index_type), ("nlist", args.nlist), ("nprobe", args.nprobe),
+                            ("hnsw_m", args.hnsw_m), ("ef_search", args.ef_search), ("pq_m", args.pq_m),
+                            ("rerank_factor", args.rerank_factor))
+        if value is not None
+    }
+    engine = RAGEngine(index_path=args.index_path, metadata_path=args.metadata_path,
+                       encode_batch_size=args.batch_size, index_params=index_params,
+                       embedding_cache_dir=args.embedding_cache_dir,
+                       dedup_threshold=args.dedup_threshold if args.dedup_threshold <= 1 else None,
+                       inference_backend=args.inference_backend, num_threads=args.num_threads,
+                       text_only=args.text_only, mmap_index=args.mmap_index)
+
+    if args.benchmark_backends:
+        if engine.text_only:
+            print("Error: --benchmark_backends needs the full CLIP model; drop --text_only.")
+            return
+        benchmark_backends(engine.clip_model, engine.clip_processor, engine.clip_model_name,
+                           num_threads=args.num_threads, batch_size=args.batch_size)
+        return
+
+    if args.rebuild_index:
+        start = time.perf_counter()
+
+        def print_progress(done, total):
+            elapsed = time.perf_counter() - start
+            rate = done / elapsed if elapsed > 0 else 0.0
+            print(f"\rEncoded {done}/{total} ({rate:.1f} items/sec)", end="\n" if done == total else "", flush=True)
+
+        if args.rebuild_workers:
+            print(f"Rebuilding FAISS index with {args.rebuild_workers} workers, shards of {args.shard_size} items...")
+            engine.rebuild_index_sharded(workers=args.rebuild_workers, shard_size=args.shard_size,
+                                         batch_size=args.batch_size, progress_callback=print_progress,
+                                         recall_k=args.recall_k)
+        else:
+            print(f"Rebuilding FAISS index with batch size {args.batch_size}...")
+            engine.create_new_index(progress_callback=print_progress, recall_k=args.recall_k)
+    elif args.recall_k:
+        engine.memory_report()
+        engine.recall_report(k=args.recall_k)
 
-    new_texts = []
-    new_image_paths = []
-    imgs = None
     if args.new_text_file:
+        def print_ingest_progress(bytes_done, bytes_total, rows_added):
+            print(f"\rIngested {bytes_done}/{bytes_total} bytes ({rows_added} chunks)",
+                  end="\n" if bytes_done == bytes_total else "", flush=True)
+
         try:
-            new_texts = engine.add_data_from_txt(args.new_text_file)
-            #print(new_texts)
+            ingest_stats = engine.ingest_text_file(args.new_text_file, commit_size=args.ingest_batch_size,
+                                                   chunk_tokens=args.chunk_tokens, chunk_overlap=args.chunk_overlap,
+                                                   resume=not args.restart_ingest,
+                                                   progress_callback=print_ingest_progress)
         except Exception as e:
             print(e)
             return
+        print(f"Added {ingest_stats['added']} text chunks from {args.new_text_file}")
         
     if args.new_img_dir:
         if not args.database_dir:
             print("Error: --database_dir is required when adding new images.")
             return
+
+        def print_image_progress(done, total):
+            print(f"\rImported {done}/{total} images", end="\n" if done == total else "", flush=True)
+
         try:
-            imgs, new_image_paths = engine.add_images(img_dir=args.new_img_dir, database_dir=args.database_dir)
-            #print(new_image_paths)
+            added_images = engine.ingest_image_dir(img_dir=args.new_img_dir, database_dir=args.database_dir,
+                                                   batch_size=args.batch_size, workers=args.image_workers,
+                                                   progress_callback=print_image_progress)
+            #print(added_images)
         except Exception as e:
             print(e)
             return
-    
-    
-    if new_texts or new_image_paths:
-        print(f"Adding {len(new_texts)} new text entries and {len(new_image_paths)} new images to FAISS index...")
-        engine.add_new_data(new_texts=new_texts, imgs=imgs, img_pths=new_image_paths)
-        print("Data successfully added and index updated!")
+        print(f"Added {len(added_images)} images from {args.new_img_dir}")
+
+    if args.delete_ids:
+        deleted = engine.delete_entries(args.delete_ids)
+        print(f"Deleted {deleted} entries")
+
+    if args.compact:
+        engine.compact()
+
+    if args.check_consistency:
+        engine.check_consistency()
+
+    if args.serve:
+        from rag_service import RAGServer  # needs pyzmq, only imported for serve mode
+
+        RAGServer(engine, address=args.serve_address, batch_window_ms=args.batch_window_ms,
+                  max_batch_size=args.max_batch_size).serve_forever()
+        return
 
     #text_query = "A polar bear lying on an ice floe, a significant symbol of the impact of climate change."
     if args.text_query:
-        ret_context, distances, indices = engine.query(text_query=args.text_query, k=3)
+        ret_context, distances, indices = engine.query(text_query=args.text_query, k=3,
+                                                       retrieval_mode=args.retrieval_mode,
+                                                       article_token_budget=args.article_token_budget,
+                                                       search_mode=args.search_mode,
+                                                       lexical_prefilter=args.lexical_prefilter)
 
         # Print query results
         print("\nQuery Results:")
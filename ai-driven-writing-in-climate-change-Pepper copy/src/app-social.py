@@ -15,7 +15,7 @@ from langchain_core.prompts import ChatPromptTemplate
 import time
 import base64
 from supabase import create_client
-from RAG import RAGEngine
+from RAG import get_rag_engine
 from PIL import Image
 from io import BytesIO
 import zmq
@@ -521,7 +521,7 @@ class ClimateStoryGenerator:
 
             if use_rag:
                 print("DEBUG - Using RAG")
-                rag = RAGEngine(index_path, metadata_path)
+                rag = get_rag_engine(index_path, metadata_path, text_only=True, mmap_index=True)  # only text queries are sent; index pages shared across workers
                 if image_base64:
                     context, distances, indices = rag.query(text_query=image_description, k=3)
                 else:
@@ -4,6 +4,7 @@ import io
 import json
 import uuid
 import base64
+import hashlib
 from typing import Tuple
 
 import requests
@@ -16,12 +17,15 @@ from langchain_core.messages import HumanMessage, AIMessage
 from langchain_core.prompts import ChatPromptTemplate
 import time
 from supabase import create_client
-from RAG import RAGEngine
+from RAG import DEFAULT_IMAGE_MATCH_SIMILARITY, get_rag_engine
+from rag_service import get_rag_client
 from PIL import Image
 from io import BytesIO
 import zmq
 from pathlib import Path
 import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 ROOT_DIR = Path(__file__).resolve().parent.parent
@@ -30,6 +34,63 @@ BUDDY_HOST = os.getenv("BUDDY_TCP_HOST", "127.0.0.1")
 BUDDY_PORT = int(os.getenv("BUDDY_TCP_PORT", "5058"))
 
 
+class IllustrationStats:
+    """
+    Illustration reuse counters. Streamlit re-executes this script on every interaction, so
+    the instance comes from illustration_stats() (st.cache_resource) to survive reruns and be
+    shared by every session of the process.
+    """
+
+    def __init__(self):
+        self.reused = 0
+        self.generated = 0
+        self.reuse_seconds = 0.0
+        self.generate_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, reused, seconds):
+        with self._lock:
+            if reused:
+                self.reused += 1
+                self.reuse_seconds += seconds
+            else:
+                self.generated += 1
+                self.generate_seconds += seconds
+
+    def summary(self):
+        with self._lock:
+            reused, generated = self.reused, self.generated
+            reuse_seconds, generate_seconds = self.reuse_seconds, self.generate_seconds
+        total = reused + generated
+        text = f"reuse hit rate {reused}/{total} ({reused / total:.0%})"
+        if not generated:
+            # No Stability call measured yet, so there is nothing to compare a reuse against
+            return text
+        # Each reuse saves an average Stability call, minus the lookup
+        saved = reused * generate_seconds / generated - reuse_seconds
+        return f"{text}, ~{max(saved, 0.0):.1f}s saved"
+
+
+@st.cache_resource
+def illustration_stats():
+    return IllustrationStats()
+
+
+# How an uploaded photo is turned into a RAG query:
+#   description - query with the vision model's description of the photo
+#   image       - query with the photo's CLIP image embedding
+#   fused       - query with the photo's CLIP image embedding and the user prompt together
+IMAGE_RETRIEVAL_MODES = ("description", "image", "fused")
+IMAGE_DESCRIPTION_PROMPT = "Describe this image in relation to climate change."
+
+
+@st.cache_resource
+def vision_executor():
+    # Vision-model calls run here, so retrieval does not wait for them. Cached so that Streamlit
+    # reruns of this script keep one pool, which the futures memoized in session state belong to.
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="vision")
+
+
 def send_to_buddy(line: str):
     if not line:
         return
@@ -41,6 +102,26 @@ def send_to_buddy(line: str):
         print(f"[buddy] send failed: {exc}")
 
 
+def image_fingerprint(base64_image, hash_size=8):
+    """
+    Perceptual difference hash (dHash) of a base64-encoded image, so the same photo uploaded
+    again (re-encoded or resized) gets the same key. Falls back to a content hash for data
+    PIL cannot decode.
+    """
+    data = base64.b64decode(base64_image)
+    try:
+        gray = Image.open(io.BytesIO(data)).convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    except Exception:
+        return "sha1:" + hashlib.sha1(data).hexdigest()
+    pixels = list(gray.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            bits = (bits << 1) | (left > pixels[row * (hash_size + 1) + col + 1])
+    return f"dhash:{bits:0{hash_size * hash_size // 4}x}"
+
+
 # TODO add the attach file to the top of the enter prompt 
 
 class SupabaseLogger:
@@ -126,10 +207,29 @@ class SupabaseLogger:
         }).eq('session_id', session_id).execute()
 
 class ClimateStoryGenerator:
-    def __init__(self):
+    def __init__(self, rag_query_options=None, rag_service=None, image_reuse_threshold=None,
+                 image_retrieval="description"):
         """
         Initialize the Climate Story Generator with necessary configurations
+
+        Args:
+            rag_query_options (dict): Extra keyword arguments for RAGEngine.query,
+                e.g. {"retrieval_mode": "article", "article_token_budget": 300}
+            rag_service (str): Address of a running RAG service (python RAG.py --serve);
+                if set, queries go there instead of loading the engine in this process
+            image_reuse_threshold (float): If set (and RAG is on), reuse an indexed image whose
+                CLIP similarity to the illustration prompt reaches this value instead of
+                generating a new one with Stability
+            image_retrieval (str): How an uploaded photo is used for retrieval, one of
+                IMAGE_RETRIEVAL_MODES; "image" and "fused" query with its CLIP embedding and
+                describe it with the vision model in the background
         """
+        if image_retrieval not in IMAGE_RETRIEVAL_MODES:
+            raise ValueError(f"Unknown image retrieval mode '{image_retrieval}'. Choose from {', '.join(IMAGE_RETRIEVAL_MODES)}.")
+        self.rag_query_options = rag_query_options or {}
+        self.rag_service = rag_service
+        self.image_reuse_threshold = image_reuse_threshold
+        self.image_retrieval = image_retrieval
 
         # Load environment variables
         load_dotenv()
@@ -173,6 +273,10 @@ class ClimateStoryGenerator:
             self.logger.log_session(st.session_state.session_id)
         if "chat_history" not in st.session_state:
             st.session_state.chat_history = []
+        if "image_descriptions" not in st.session_state:
+            # (image fingerprint, prompt) -> future of its vision-model description
+            st.session_state.image_descriptions = {}
+            st.session_state.logged_image_descriptions = set()
 
     def setup_ui(self):
         """
@@ -222,6 +326,8 @@ class ClimateStoryGenerator:
         st.session_state.image_history = []
         st.session_state.current_story = None
         st.session_state.current_image_description = None
+        st.session_state.image_descriptions = {}
+        st.session_state.logged_image_descriptions = set()
         
         # Generate a new session ID for the next session
         st.session_state.chat_session_id = str(uuid.uuid4())
@@ -292,6 +398,39 @@ class ClimateStoryGenerator:
         )
         return chat_completion.choices[0].message.content
 
+    def describe_image_async(self, base64_image, prompt=IMAGE_DESCRIPTION_PROMPT):
+        """
+        Start image_to_text in the background, at most once per image and prompt in this
+        session: uploads with the same fingerprint share the first request.
+
+        Returns:
+            Future: Resolves to the image description
+        """
+        return self._description_future((image_fingerprint(base64_image), prompt), base64_image)
+
+    def _description_future(self, key, base64_image):
+        memo = st.session_state.image_descriptions
+        if key not in memo:
+            memo[key] = vision_executor().submit(self.image_to_text, base64_image, key[1])
+        return memo[key]
+
+    def describe_image(self, base64_image, prompt=IMAGE_DESCRIPTION_PROMPT):
+        """
+        Description of an uploaded image (waits for describe_image_async). It is logged to
+        Supabase the first time it is returned in the session.
+        """
+        key = (image_fingerprint(base64_image), prompt)
+        try:
+            description = self._description_future(key, base64_image).result()
+        except Exception:
+            # Forget the failed request so a later turn asks again
+            st.session_state.image_descriptions.pop(key, None)
+            raise
+        if key not in st.session_state.logged_image_descriptions:
+            st.session_state.logged_image_descriptions.add(key)
+            self.logger.log_image_description(st.session_state.session_id, description)
+        return description
+
     def generate_story(self, input_text):
         """
         Generate a short story based on input
@@ -332,6 +471,50 @@ class ClimateStoryGenerator:
         else:
             raise Exception(str(response.json()))
         
+    def _get_rag(self, index_path, metadata_path):
+        """
+        The RAG service client, or the engine shared by this process
+        """
+        if self.rag_service:
+            rag = get_rag_client(self.rag_service)
+        else:
+            # Only text queries are sent unless photos are embedded directly; index pages shared across workers
+            rag = get_rag_engine(index_path, metadata_path, text_only=self.image_retrieval == "description",
+                                 mmap_index=True)
+        return rag
+
+    def illustrate(self, description, use_rag=False, index_path=None, metadata_path=None):
+        """
+        Image for an illustration prompt: an indexed image that matches it closely enough
+        (when image reuse is enabled), otherwise a new one from Stability.
+
+        Returns:
+            (bytes, bool): The image bytes and whether an indexed image was reused
+        """
+        if use_rag and self.image_reuse_threshold is not None:
+            start = time.perf_counter()
+            match = None
+            try:
+                match = self._get_rag(index_path, metadata_path).match_image(description, min_similarity=self.image_reuse_threshold)
+                image_bytes = Path(match["image_path"]).read_bytes() if match else None
+            except Exception as e:
+                print(f"Error: image reuse lookup failed: {e}")
+                image_bytes = None
+            if image_bytes is not None:
+                illustration_stats().record(True, time.perf_counter() - start)
+                self._log_illustration_stats(f"reused {match['image_path']} (similarity {match['similarity']:.3f})")
+                return image_bytes, True
+
+        start = time.perf_counter()
+        image_bytes = self.generate_story_image(description)
+        illustration_stats().record(False, time.perf_counter() - start)
+        if use_rag and self.image_reuse_threshold is not None:
+            self._log_illustration_stats("generated")
+        return image_bytes, False
+
+    def _log_illustration_stats(self, outcome):
+        print(f"DEBUG - Illustration {outcome}; {illustration_stats().summary()}")
+
     def display_streaming_story(self, story, delay=0.005):
         """
         Display the story character by character with a streaming effect
@@ -457,7 +640,7 @@ class ClimateStoryGenerator:
             st.session_state["current_image_description"] = image_description
             
             # Generate new image based on the updated description
-            image_bytes = self.generate_story_image(image_description)
+            image_bytes, reused = self.illustrate(image_description, use_rag, index_path, metadata_path)
             image = Image.open(io.BytesIO(image_bytes))
             image_buffer = io.BytesIO()
             image.save(image_buffer, format="PNG")
@@ -472,7 +655,7 @@ class ClimateStoryGenerator:
             # Store new image
             storage_path = self.logger.store_image(
                 st.session_state.session_id,
-                'generated',
+                'reused' if reused else 'generated',
                 image_buffer.getvalue(),
                 image_description
             )
@@ -532,7 +715,7 @@ class ClimateStoryGenerator:
             st.session_state["current_image_description"] = image_description
             
             # Generate new image based on the updated description
-            image_bytes = self.generate_story_image(image_description)
+            image_bytes, reused = self.illustrate(image_description, use_rag, index_path, metadata_path)
             image = Image.open(io.BytesIO(image_bytes))
             image_buffer = io.BytesIO()
             image.save(image_buffer, format="PNG")
@@ -547,7 +730,7 @@ class ClimateStoryGenerator:
             # Store new image
             storage_path = self.logger.store_image(
                 st.session_state.session_id,
-                'generated',
+                'reused' if reused else 'generated',
                 image_buffer.getvalue(),
                 image_description
             )
@@ -563,16 +746,31 @@ class ClimateStoryGenerator:
             # Proceed with normal story generation
             image_description = ""
             if image_base64:
-                image_description = self.image_to_text(image_base64, "Describe this image in relation to climate change.")
-                self.logger.log_image_description(st.session_state.session_id, image_description)
+                # Shares the request run() started for this upload
+                self.describe_image_async(image_base64)
+                if not (use_rag and self.image_retrieval != "description"):
+                    image_description = self.describe_image(image_base64)
 
             if use_rag:
                 print("DEBUG - Using RAG")
-                rag = RAGEngine(index_path, metadata_path)
-                if image_base64:
-                    context, distances, indices = rag.query(text_query=image_description, k=3)
+                rag = self._get_rag(index_path, metadata_path)
+                photo_results = None
+                if image_base64 and self.image_retrieval != "description":
+                    # Query with the photo itself while the vision model is still describing it
+                    photo = Image.open(io.BytesIO(base64.b64decode(image_base64)))
+                    text_query = user_prompt if self.image_retrieval == "fused" else None
+                    try:
+                        photo_results = rag.query(text_query=text_query, image=photo, k=3, **self.rag_query_options)
+                    except Exception as e:
+                        # e.g. a retrieval service started with --text_only cannot encode images
+                        print(f"Error: {self.image_retrieval} image query failed ({e}); querying with the image description instead.")
+                        image_description = self.describe_image(image_base64)
+                if photo_results is not None:
+                    context, distances, indices = photo_results
+                elif image_base64:
+                    context, distances, indices = rag.query(text_query=image_description, k=3, **self.rag_query_options)
                 else:
-                    context, distances, indices = rag.query(text_query=user_prompt, k=3)
+                    context, distances, indices = rag.query(text_query=user_prompt, k=3, **self.rag_query_options)
                 formatted_contexts = "\n".join([f"- **Context {i+1}**: {context}" for i, context in enumerate(context)])
 
                 template = """
@@ -593,6 +791,10 @@ class ClimateStoryGenerator:
                 User prompt: {user_prompt}
                 Image description: {image_description}
                 """
+
+            if image_base64:
+                # The story prompt still needs the description
+                image_description = self.describe_image(image_base64)
             
             prompt = ChatPromptTemplate.from_template(template)
             prompt_text = prompt.format(
@@ -609,7 +811,7 @@ class ClimateStoryGenerator:
             st.session_state["current_image_description"] = image_prompt
 
             # Generate and display image
-            image_bytes = self.generate_story_image(image_prompt)
+            image_bytes, reused = self.illustrate(image_prompt, use_rag, index_path, metadata_path)
             image = Image.open(io.BytesIO(image_bytes))
             image_buffer = io.BytesIO()
             image.save(image_buffer, format="PNG")
@@ -624,7 +826,7 @@ class ClimateStoryGenerator:
             # Store image and log chat
             self.logger.store_image(
                 st.session_state.session_id,
-                'generated',
+                'reused' if reused else 'generated',
                 image_buffer.getvalue(),
                 image_prompt
             )
@@ -676,12 +878,8 @@ class ClimateStoryGenerator:
                 uploaded_image.seek(0)
                 image_base64 = self.encode_image(uploaded_image)
                 
-                # Generate image description when an image is uploaded
-                image_description = self.image_to_text(image_base64, "Describe this image in relation to climate change.")
-                self.logger.log_image_description(st.session_state.session_id, image_description)
-                
-                # Log the image upload with the description instead of generic message
-                self.logger.log_chat(st.session_state.session_id, 'Image', f"Image description: {image_description}")
+                # Describe the uploaded image in the background; get_response waits for it only when needed
+                self.describe_image_async(image_base64)
             else:
                 image_base64 = None
 
@@ -694,6 +892,11 @@ class ClimateStoryGenerator:
                     user_prompt=user_query,
                     uploaded_image=uploaded_image
                 )
+
+            if image_base64:
+                image_description = self.describe_image(image_base64)
+                # Log the image upload with the description instead of generic message
+                self.logger.log_chat(st.session_state.session_id, 'Image', f"Image description: {image_description}")
             
             self.save_image_buffer_to_png(generated_image, "current.png")
             image_prompt, story_text_clean = self._parse_model_output(ai_response)
@@ -762,14 +965,20 @@ class ClimateStoryGenerator:
             self._reset_session_state()
                 
                 
-def main(use_rag, index_path=None, metadata_path=None):
+def main(use_rag, index_path=None, metadata_path=None, rag_query_options=None, rag_service=None, image_reuse_threshold=None,
+         image_retrieval="description"):
     """
     Main entry point for the Climate Change Story Generator.
     """
     # Initialize the story generator
-    generator = ClimateStoryGenerator()
+    generator = ClimateStoryGenerator(rag_query_options=rag_query_options, rag_service=rag_service,
+                                      image_reuse_threshold=image_reuse_threshold, image_retrieval=image_retrieval)
+
+    if use_rag and rag_service:
+        # The service holds the index; nothing to load here
+        generator.run(use_rag=True)
 
-    if use_rag:
+    elif use_rag:
         # Ensure index and metadata paths are provided
         if not index_path or not metadata_path:
             print("Error: --index_path and --metadata_path are required when using RAG.")
@@ -799,6 +1008,20 @@ if __name__ == "__main__":
     parser.add_argument("--index_path", type=str, default="./faiss_indices/faiss_index.idx", help="Path to the FAISS index file (required if using RAG).")
     parser.add_argument("--metadata_path", type=str, default="./faiss_indices/combined_metadata.json", help="Path to the metadata JSON file (required if using RAG).")
 
+    parser.add_argument("--retrieval_mode", type=str, choices=("chunk", "neighbors", "article"), default="chunk", help="RAG context granularity: matched chunks, chunks with neighbours, or whole articles.")
+    parser.add_argument("--article_token_budget", type=int, default=None, help="Maximum CLIP tokens per RAG context in neighbors/article mode.")
+    parser.add_argument("--search_mode", type=str, choices=("dense", "hybrid", "lexical"), default="dense", help="RAG search: CLIP embeddings, BM25 keywords, or both fused.")
+    parser.add_argument("--reuse_images", action="store_true", help="With --use_rag, reuse a similar image from the indexed image database instead of generating one with Stability.")
+    parser.add_argument("--image_reuse_threshold", type=float, default=DEFAULT_IMAGE_MATCH_SIMILARITY, help="CLIP text-to-image similarity an indexed image needs to be reused (with --reuse_images).")
+    parser.add_argument("--image_retrieval", choices=IMAGE_RETRIEVAL_MODES, default="description", help="How an uploaded photo is used for retrieval: the vision model's description of it, its CLIP image embedding ('image'), or its embedding fused with the prompt ('fused').")
+    parser.add_argument("--rag_service", type=str, default=None, help="Address of a shared RAG service started with `python RAG.py --serve` (e.g. tcp://127.0.0.1:5560) instead of loading the index in this process.")
+
     args = parser.parse_args()
 
-    main(args.use_rag, args.index_path, args.metadata_path)
+    rag_query_options = {
+        "retrieval_mode": args.retrieval_mode,
+        "article_token_budget": args.article_token_budget,
+        "search_mode": args.search_mode,
+    }
+    main(args.use_rag, args.index_path, args.metadata_path, rag_query_options, args.rag_service,
+         args.image_reuse_threshold if args.reuse_images else None, args.image_retrieval)
@@ -0,0 +1,59 @@
+# CLIP's text encoder sees 77 positions, two of which are the start/end tokens
+CLIP_CONTEXT_TOKENS = 77
+DEFAULT_CHUNK_TOKENS = CLIP_CONTEXT_TOKENS - 2
+DEFAULT_CHUNK_OVERLAP = 15
+DEFAULT_MIN_CHUNK_TOKENS = 8
+
+
+def _starts_word(offsets, position):
+    # A token starts a word when there is a gap (whitespace) before it
+    return position == 0 or offsets[position][0] > offsets[position - 1][1]
+
+
+def token_windows(offsets, max_tokens=DEFAULT_CHUNK_TOKENS, overlap=DEFAULT_CHUNK_OVERLAP):
+    """
+    Split a token sequence into overlapping windows of at most `max_tokens` tokens.
+
+    Window edges are moved to word starts where possible, so words are not cut into
+    sub-word pieces. The last window keeps the normal overlap with the previous one, even
+    if that leaves it short: shifting it back to full size would make it overlap almost
+    entirely, and near-duplicate detection would then drop it along with its tail tokens.
+
+    Parameters:
+    - offsets: (start_char, end_char) per token, as returned by a fast tokenizer.
+    - max_tokens: Token budget per window.
+    - overlap: Tokens shared by consecutive windows.
+
+    Returns:
+    - List of (first_token, end_token) half-open ranges.
+    """
+    count = len(offsets)
+    step = max(1, max_tokens - overlap)
+    windows = []
+    start = 0
+    while start < count:
+        end = min(start + max_tokens, count)
+        if end < count:
+            boundary = end
+            while boundary > start + step // 2 and not _starts_word(offsets, boundary):
+                boundary -= 1
+            if boundary > start + step // 2:
+                end = boundary
+        windows.append((start, end))
+        if end == count:
+            break
+        next_start = max(end - overlap, start + 1)
+        while next_start < end and not _starts_word(offsets, next_start):
+            next_start += 1
+        start = next_start
+    return windows
+
+
+def empty_chunk_stats():
+    return {"texts": 0, "chunks": 0, "tokens": 0, "embedded_tokens": 0, "dropped_chunks": 0, "dropped_tokens": 0}
+
+
+def merge_chunk_stats(total, stats):
+    for key, value in stats.items():
+        total[key] = total.get(key, 0) + value
+    return total
@@ -0,0 +1,237 @@
+import os
+import time
+
+import numpy as np
+
+# torch is imported inside the functions that need it, so importing this module stays cheap
+
+BACKENDS = ("torch", "torch-int8", "onnx")
+DEFAULT_BACKEND = "torch"
+DEFAULT_ONNX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "rag_clip_onnx")
+
+
+class TorchBackend:
+    """
+    Runs CLIP's text and vision towers with PyTorch under inference_mode.
+
+    With quantize=True the Linear layers are dynamically quantized to int8 (weights stored as
+    int8, activations quantized on the fly), which speeds up CPU inference of the transformer
+    blocks while keeping embeddings within a small cosine distance of the float32 model.
+    """
+
+    name = "torch"
+
+    def __init__(self, model, quantize=False):
+        import torch
+
+        self._torch = torch
+        model.eval()
+        if quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            self.name = "torch-int8"
+        self.model = model
+
+    def text_features(self, inputs):
+        with self._torch.inference_mode():
+            return _text_features(self.model, inputs).cpu().numpy()
+
+    def image_features(self, inputs):
+        with self._torch.inference_mode():
+            return self.model.get_image_features(**inputs).cpu().numpy()
+
+
+def _text_features(model, inputs):
+    # CLIPModel has get_text_features; the text-only CLIPTextModelWithProjection returns text_embeds
+    if hasattr(model, "get_text_features"):
+        return model.get_text_features(**inputs)
+    return model(**inputs).text_embeds
+
+
+def _has_vision_tower(model):
+    return hasattr(model, "get_image_features")
+
+
+class OnnxBackend:
+    """
+    Runs CLIP's towers as ONNX graphs with onnxruntime.
+
+    The graphs are exported once per model into `onnx_dir` (with dynamic batch and sequence
+    axes) and reused by later runs.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model, model_name, onnx_dir=None, num_threads=None):
+        import onnxruntime  # optional dependency, only needed for this backend
+
+        export_dir = os.path.join(onnx_dir or DEFAULT_ONNX_DIR, model_name.replace("/", "--"))
+        text_path = os.path.join(export_dir, "text.onnx")
+        vision_path = os.path.join(export_dir, "vision.onnx") if _has_vision_tower(model) else None
+        if not os.path.exists(text_path) or (vision_path and not os.path.exists(vision_path)):
+            self._export(model, export_dir, text_path, vision_path)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        self.text_session = onnxruntime.InferenceSession(text_path, options, providers=providers)
+        self.vision_session = (
+            onnxruntime.InferenceSession(vision_path, options, providers=providers) if vision_path else None
+        )
+
+    @staticmethod
+    def _export(model, export_dir, text_path, vision_path=None):
+        import torch
+
+        class TextTower(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.model = model
+
+            def forward(self, input_ids, attention_mask):
+                return _text_features(self.model, {"input_ids": input_ids, "attention_mask": attention_mask})
+
+        class VisionTower(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.model = model
+
+            def forward(self, pixel_values):
+                return self.model.get_image_features(pixel_values=pixel_values)
+
+        os.makedirs(export_dir, exist_ok=True)
+        model.eval()
+        input_ids = torch.ones((2, 8), dtype=torch.long)
+        attention_mask = torch.ones((2, 8), dtype=torch.long)
+        # Write to temporary names first so an interrupted export is not picked up as complete
+        with torch.inference_mode():
+            torch.onnx.export(
+                TextTower(), (input_ids, attention_mask), text_path + ".tmp",
+                input_names=["input_ids", "attention_mask"], output_names=["text_embeds"],
+                dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"},
+                              "text_embeds": {0: "batch"}},
+                opset_version=17,
+            )
+            if vision_path:
+                size = model.config.vision_config.image_size
+                pixel_values = torch.zeros((2, 3, size, size), dtype=torch.float32)
+                torch.onnx.export(
+                    VisionTower(), (pixel_values,), vision_path + ".tmp",
+                    input_names=["pixel_values"], output_names=["image_embeds"],
+                    dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+                    opset_version=17,
+                )
+        os.replace(text_path + ".tmp", text_path)
+        if vision_path:
+            os.replace(vision_path + ".tmp", vision_path)
+
+    def text_features(self, inputs):
+        feed = {
+            "input_ids": inputs["input_ids"].cpu().numpy().astype(np.int64),
+            "attention_mask": inputs["attention_mask"].cpu().numpy().astype(np.int64),
+        }
+        return self.text_session.run(None, feed)[0]
+
+    def image_features(self, inputs):
+        return self.vision_session.run(None, {"pixel_values": inputs["pixel_values"].cpu().numpy()})[0]
+
+
+def create_backend(model, model_name, backend=DEFAULT_BACKEND, num_threads=None, onnx_dir=None, fallback=True):
+    """
+    Build the inference backend used by RAGEngine to run CLIP.
+
+    Parameters:
+    - model: The loaded CLIPModel.
+    - model_name: Hugging Face name of the model (names the exported ONNX graphs).
+    - backend: One of BACKENDS.
+    - num_threads: Intra-op CPU threads (None keeps the library default).
+    - onnx_dir: Where ONNX graphs are exported to and loaded from.
+    - fallback: Use torch when onnxruntime is missing (otherwise the ImportError is raised).
+
+    Returns:
+    - Backend object with text_features(inputs) and image_features(inputs) returning numpy arrays.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}'. Choose from {', '.join(BACKENDS)}.")
+    if num_threads:
+        import torch
+        torch.set_num_threads(num_threads)
+    if backend == "onnx":
+        try:
+            return OnnxBackend(model, model_name, onnx_dir=onnx_dir, num_threads=num_threads)
+        except ImportError:
+            if not fallback:
+                raise
+            print("Error: the onnx backend needs the onnxruntime (and onnx) packages; using torch instead.")
+            backend = DEFAULT_BACKEND
+    return TorchBackend(model, quantize=backend == "torch-int8")
+
+
+def _cosine_rows(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return (a * b).sum(axis=1)
+
+
+def benchmark_backends(model, processor, model_name, backends=BACKENDS, num_threads=None, batch_size=8,
+                       repeats=5, onnx_dir=None):
+    """
+    Time every backend on the same text and image batches and compare its embeddings with the
+    stock float32 PyTorch model (the one existing indexes were built with).
+
+    Returns:
+    - Dict of backend -> {"text_ms", "image_ms" (per item), "text_cosine_min", "image_cosine_min",
+      "text_speedup", "image_speedup"}, or {"error": message} for a backend that could not run.
+    """
+    import torch
+
+    if not _has_vision_tower(model):
+        raise ValueError("benchmark_backends needs the full CLIP model; load the engine without text_only.")
+
+    texts = [f"Melting sea ice threatens polar bear habitat, report {i} says." for i in range(batch_size)]
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 255, (224, 224, 3), dtype=np.uint8) for _ in range(batch_size)]
+    text_inputs = processor(text=texts, return_tensors="pt", padding=True, truncation=True)
+    image_inputs = processor(images=images, return_tensors="pt")
+
+    def timed(encode, inputs):
+        encode(inputs)  # warm-up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            output = encode(inputs)
+        return output, (time.perf_counter() - start) * 1000 / (repeats * batch_size)
+
+    # Reference: the pre-existing path, the float32 model under torch.no_grad
+    with torch.no_grad():
+        ref_text, ref_text_ms = timed(lambda inputs: model.get_text_features(**inputs).cpu().numpy(), text_inputs)
+        ref_image, ref_image_ms = timed(lambda inputs: model.get_image_features(**inputs).cpu().numpy(), image_inputs)
+    print(f"baseline (torch, no_grad): text {ref_text_ms:.2f} ms/item, image {ref_image_ms:.2f} ms/item")
+
+    results = {}
+    for name in backends:
+        try:
+            # quantize_dynamic works on a copy, so the float32 model stays the reference.
+            # No torch fallback: a missing onnxruntime must not be reported as the torch numbers
+            backend = create_backend(model, model_name, name, num_threads=num_threads, onnx_dir=onnx_dir,
+                                     fallback=False)
+            text, text_ms = timed(backend.text_features, text_inputs)
+            image, image_ms = timed(backend.image_features, image_inputs)
+        except Exception as e:
+            print(f"{name}: failed ({e})")
+            results[name] = {"error": str(e)}
+            continue
+        results[name] = {
+            "text_ms": text_ms,
+            "image_ms": image_ms,
+            "text_speedup": ref_text_ms / text_ms,
+            "image_speedup": ref_image_ms / image_ms,
+            "text_cosine_min": float(_cosine_rows(text, ref_text).min()),
+            "image_cosine_min": float(_cosine_rows(image, ref_image).min()),
+        }
+        r = results[name]
+        print(f"{backend.name}: text {text_ms:.2f} ms/item ({r['text_speedup']:.2f}x), image {image_ms:.2f} ms/item "
+              f"({r['image_speedup']:.2f}x); min cosine to baseline text {r['text_cosine_min']:.4f}, "
+              f"image {r['image_cosine_min']:.4f}")
+    return results
+
@@ -0,0 +1,157 @@
+import json
+import os
+import re
+import threading
+
+import faiss
+import numpy as np
+
+from metadata_store import atomic_write
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are then only serialized within one process
+    fcntl = None
+
+# segment-<first metadata row>-<row count>.npz
+_SEGMENT_NAME = re.compile(r"^segment-(\d{12})-(\d{8})\.npz$")
+
+
+def atomic_write_index(index, path):
+    """
+    faiss.write_index with the same write-then-rename guarantee as atomic_write.
+    """
+    atomic_write(path, lambda f: faiss.write_index(index, faiss.PyCallbackIOWriter(f.write)))
+
+
+def write_segment(directory, base_row, vectors, entries):
+    """
+    Atomically write one append-only delta segment.
+
+    Parameters:
+    - directory: Segment directory (created if missing).
+    - base_row: Metadata row of the first entry in the segment.
+    - vectors: (n, dim) normalized embeddings.
+    - entries: The n metadata entries.
+
+    Returns:
+    - Path of the written segment.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"segment-{base_row:012d}-{len(entries):08d}.npz")
+    payload = np.frombuffer(json.dumps(entries, ensure_ascii=False).encode("utf-8"), dtype=np.uint8)
+    atomic_write(path, lambda f: np.savez(f, vectors=np.asarray(vectors, dtype=np.float32), metadata=payload))
+    return path
+
+
+def list_segments(directory):
+    """
+    Segments in `directory` as (base_row, row_count, path), ordered by base_row.
+    """
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for name in os.listdir(directory):
+        match = _SEGMENT_NAME.match(name)
+        if match:
+            segments.append((int(match.group(1)), int(match.group(2)), os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def read_segment(path):
+    """
+    Returns:
+    - (vectors, entries) stored in the segment.
+    """
+    with np.load(path) as data:
+        vectors = data["vectors"]
+        entries = json.loads(data["metadata"].tobytes().decode("utf-8"))
+    return vectors, entries
+
+
+def write_vectors_file(path, vectors):
+    """
+    Atomically write the raw float32 side file holding the exact vectors of a quantized index.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    atomic_write(path, lambda f: f.write(memoryview(vectors).cast("B")))
+
+
+def append_vectors_file(path, rows, vectors):
+    """
+    Append vectors to a side file after its first `rows` rows.
+
+    Anything past `rows` (left by a compaction that never committed its index) is cut off
+    first, so row i of the file always matches row i of the index that is published next.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    with open(path, "r+b") as f:
+        f.truncate(rows * vectors.shape[1] * vectors.itemsize)
+        f.seek(0, os.SEEK_END)
+        f.write(memoryview(vectors).cast("B"))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def open_vectors_file(path, rows, dim):
+    """
+    Memory-map the first `rows` vectors of a side file read-only, or None if it is missing or short.
+    """
+    row_bytes = dim * np.dtype(np.float32).itemsize
+    if not os.path.exists(path) or os.path.getsize(path) < rows * row_bytes or not rows:
+        return None
+    return np.memmap(path, dtype=np.float32, mode="r", shape=(rows, dim))
+
+
+class WriterLock:
+    """
+    Exclusive lock on a lock file, held while an engine writes the index, metadata, ids file
+    or delta segments. Readers never take it.
+
+    Re-entrant within the owning thread: its outermost acquire takes the file lock and its last
+    release frees it. Other threads of the process block until then, as other processes do.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._guard = threading.RLock()  # held by the owning thread for as long as it writes
+        self._owner = None
+        self._depth = 0
+        self._file = None
+
+    def acquire(self):
+        """
+        Returns:
+        - True if this call took the file lock, False if this thread already held it.
+        """
+        self._guard.acquire()
+        if self._owner == threading.get_ident():
+            self._depth += 1
+            return False
+        try:
+            lock_file = open(self.path, "a+b")
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            except BaseException:
+                lock_file.close()
+                raise
+        except BaseException:
+            self._guard.release()
+            raise
+        self._file = lock_file
+        self._owner = threading.get_ident()
+        self._depth = 1
+        return True
+
+    def release(self):
+        if self._owner != threading.get_ident():
+            raise RuntimeError("WriterLock released by a thread that does not hold it.")
+        self._depth -= 1
+        if not self._depth:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+            self._owner = None
+        self._guard.release()
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Persistent content-addressed cache of normalized CLIP embeddings.
+
+    Vectors are appended to a raw float32 file that is read through a memory map, and a
+    SQLite table maps each content hash to its row in that file. Keys include the model
+    name (with the inference backend when it is not float32 PyTorch), so one cache directory
+    can serve several models, backends and every index type.
+    """
+
+    def __init__(self, cache_dir, dim):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.dim = dim
+        self.hits = 0
+        self.misses = 0
+        self._row_bytes = dim * np.dtype(np.float32).itemsize
+        self._vectors_path = os.path.join(cache_dir, f"vectors_{dim}.f32")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(cache_dir, f"keys_{dim}.sqlite"), check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS keys (hash TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        self._conn.commit()
+
+        # Drop a partially written trailing row left behind by an interrupted append
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        self._rows = size // self._row_bytes
+        if size != self._rows * self._row_bytes:
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(self._rows * self._row_bytes)
+        self._vectors = None
+
+    @staticmethod
+    def content_hash(model_name, kind, content):
+        """
+        Hash of (model, kind, content). `content` is a str for text or bytes for images.
+        """
+        digest = hashlib.sha256(f"{model_name}\0{kind}\0".encode("utf-8"))
+        digest.update(content.encode("utf-8") if isinstance(content, str) else content)
+        return digest.hexdigest()
+
+    @staticmethod
+    def file_hash(model_name, kind, path, chunk_size=1 << 20):
+        """
+        Same as content_hash with the file's bytes as content, read in chunks.
+        """
+        digest = hashlib.sha256(f"{model_name}\0{kind}\0".encode("utf-8"))
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(chunk_size), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _mapped_vectors(self):
+        if self._vectors is None or len(self._vectors) < self._rows:
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(self._rows, self.dim))
+        return self._vectors
+
+    def get_many(self, hashes):
+        """
+        Look up embeddings by content hash.
+
+        Returns:
+        - Dict of hash -> embedding for the hashes found in the cache.
+        """
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                found.update(self._conn.execute(
+                    f"SELECT hash, row FROM keys WHERE hash IN ({placeholders})", batch).fetchall())
+            vectors = self._mapped_vectors() if found else None
+            self.hits += len(found)
+            self.misses += len(unique) - len(found)
+            return {key: np.array(vectors[row]) for key, row in found.items()}
+
+    def put_many(self, hashes, embeddings):
+        """
+        Append embeddings for hashes not yet in the cache.
+        """
+        with self._lock:
+            existing = set()
+            for start in range(0, len(hashes), 500):
+                batch = list(hashes[start:start + 500])
+                placeholders = ",".join("?" * len(batch))
+                existing.update(key for (key,) in self._conn.execute(
+                    f"SELECT hash FROM keys WHERE hash IN ({placeholders})", batch))
+            new_rows = []
+            with open(self._vectors_path, "ab") as f:
+                for key, embedding in zip(hashes, embeddings):
+                    if key in existing:
+                        continue
+                    existing.add(key)
+                    f.write(np.asarray(embedding, dtype=np.float32).tobytes())
+                    new_rows.append((key, self._rows + len(new_rows)))
+                f.flush()
+                os.fsync(f.fileno())
+            # Vectors are on disk before their keys are committed, so a key never points past the file
+            with self._conn:
+                self._conn.executemany("INSERT INTO keys (hash, row) VALUES (?, ?)", new_rows)
+            self._rows += len(new_rows)
+
+    def stats(self):
+        return {"entries": self._rows, "hits": self.hits, "misses": self.misses}
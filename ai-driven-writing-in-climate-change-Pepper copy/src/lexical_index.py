@@ -0,0 +1,139 @@
+import math
+import re
+import threading
+from array import array
+
+import numpy as np
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+# Very common English words carry no retrieval signal and make the longest posting lists
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have in is it its of on or that the their this to was were "
+    "will with which who what when where how".split()
+)
+
+# Title terms count as if they appeared this many times in the content
+TITLE_BOOST = 2
+
+
+def tokenize(text):
+    return [token for token in _TOKEN.findall(text.casefold()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    In-memory BM25 inverted index over the title and content of metadata rows.
+
+    Each term maps to an append-only posting list of (row, term frequency), so rows can be
+    added incrementally as they are ingested. A query only touches the posting lists of its
+    own terms, which keeps keyword lookups far below a dense scan of the whole index.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._rows = {}  # term -> array('q') of rows
+        self._freqs = {}  # term -> array('f') of term frequencies
+        self._doc_lengths = array("f")
+        self._total_length = 0.0
+        self._documents = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._doc_lengths)
+
+    def add(self, row, title="", content=""):
+        """
+        Index one metadata row. Rows must be added in increasing order; gaps (e.g. images) are
+        recorded as empty documents.
+        """
+        counts = {}
+        for token in tokenize(content or ""):
+            counts[token] = counts.get(token, 0) + 1
+        for token in tokenize(title or ""):
+            counts[token] = counts.get(token, 0) + TITLE_BOOST
+        length = float(sum(counts.values()))
+        with self._lock:
+            while len(self._doc_lengths) < row:
+                self._doc_lengths.append(0.0)
+            self._doc_lengths.append(length)
+            if not counts:
+                return
+            for token, count in counts.items():
+                if token not in self._rows:
+                    self._rows[token] = array("q")
+                    self._freqs[token] = array("f")
+                self._rows[token].append(row)
+                self._freqs[token].append(count)
+            self._total_length += length
+            self._documents += 1
+
+    def search(self, query, k=10, allowed=None):
+        """
+        Top-k rows for a keyword query by BM25 score.
+
+        Parameters:
+        - query: Query text.
+        - k: Number of rows to return (None for every matching row).
+        - allowed: Optional boolean array over rows; other rows are skipped.
+
+        Returns:
+        - (rows, scores) numpy arrays, best first.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        with self._lock:
+            if not terms or not self._documents:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            doc_lengths = np.frombuffer(self._doc_lengths, dtype=np.float32)
+            average_length = self._total_length / self._documents
+            all_rows, all_scores = [], []
+            postings = freqs = None
+            for term in terms:
+                if term not in self._rows:
+                    continue
+                postings = np.frombuffer(self._rows[term], dtype=np.int64)
+                freqs = np.frombuffer(self._freqs[term], dtype=np.float32)
+                idf = math.log(1 + (self._documents - len(postings) + 0.5) / (len(postings) + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * doc_lengths[postings] / average_length)
+                all_rows.append(postings.copy())
+                all_scores.append(idf * freqs * (self.k1 + 1) / (freqs + norm))
+            # Views on the posting buffers must be gone before add() grows them again
+            del postings, freqs, doc_lengths
+            if not all_rows:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            rows = np.concatenate(all_rows)
+            scores = np.concatenate(all_scores)
+
+        if allowed is not None:
+            keep = rows < len(allowed)
+            keep[keep] = allowed[rows[keep]]
+            rows, scores = rows[keep], scores[keep]
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        totals = np.bincount(inverse, weights=scores).astype(np.float32)
+        if k is not None and len(totals) > k:
+            top = np.argpartition(-totals, k - 1)[:k]
+        else:
+            top = np.arange(len(totals))
+        order = top[np.argsort(-totals[top], kind="stable")]
+        return unique_rows[order], totals[order]
+
+
+def reciprocal_rank_fusion(rankings, weights=None, constant=60):
+    """
+    Fuse ranked row lists: each row scores sum(weight / (constant + rank)) over the lists it is in.
+
+    Returns:
+    - (rows, scores) numpy arrays, best first.
+    """
+    weights = weights or [1.0] * len(rankings)
+    fused = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, row in enumerate(ranking):
+            row = int(row)
+            if row < 0:
+                continue
+            fused[row] = fused.get(row, 0.0) + weight / (constant + rank + 1)
+    ordered = sorted(fused.items(), key=lambda item: -item[1])
+    return (np.array([row for row, _ in ordered], dtype=np.int64),
+            np.array([score for _, score in ordered], dtype=np.float32))
@@ -0,0 +1,303 @@
+import io
+import json
+import os
+import sqlite3
+import threading
+
+SQLITE_SUFFIXES = (".sqlite", ".sqlite3", ".db")
+
+# Fields kept in their own columns so they can be scanned without decoding every row; each has a
+# covering (row_id, field) index, so the scans on every load (attribute, article and stable-ID
+# lookups) read the index alone. ID and uid have no declared type: values come back as stored,
+# like json_extract returns them.
+_COLUMN_FIELDS = ("type", "source", "ID", "uid")
+_COLUMN_DEFINITIONS = {"type": "type TEXT", "source": "source TEXT", "ID": "ID", "uid": "uid"}
+_INSERT_SQL = "INSERT INTO entries (row_id, type, source, ID, uid, entry) VALUES (?, ?, ?, ?, ?, ?)"
+
+
+def _row_values(row, entry):
+    return (row, entry.get("type"), entry.get("source"), entry.get("ID"), entry.get("uid"),
+            json.dumps(entry, ensure_ascii=False))
+
+
+class SQLiteMetadataStore:
+    """
+    Metadata rows stored in SQLite, one row per FAISS row.
+
+    Behaves like the list returned by json.load (len, [row], iteration, append/extend),
+    but opening the file does not parse the corpus, lookups by FAISS row id go through
+    the primary key, and appends only write the new rows.
+
+    Rows replayed from delta segments on load are kept in memory (see overlay), so opening
+    an index never writes to the database; the next write persists them first.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # One connection shared by all Streamlit session threads, guarded by self._lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "row_id INTEGER PRIMARY KEY, type TEXT, source TEXT, ID, uid, entry TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        self._columns = {info[1] for info in self._conn.execute("PRAGMA table_info(entries)")}
+        if self._columns.issuperset(_COLUMN_FIELDS):
+            self._create_field_indexes()
+        # Rows served from the database; rows after them come from self._overlay
+        self._count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        self._overlay = []
+
+    def __len__(self):
+        return self._count + len(self._overlay)
+
+    def __getitem__(self, row):
+        if not isinstance(row, (int,)) and hasattr(row, "__index__"):
+            row = row.__index__()  # numpy integers coming from FAISS results
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(f"metadata row {row} out of range")
+        if row >= self._count:
+            return dict(self._overlay[row - self._count])
+        with self._lock:
+            found = self._conn.execute("SELECT entry FROM entries WHERE row_id = ?", (row,)).fetchone()
+        return json.loads(found[0])
+
+    def __iter__(self):
+        # Page through the table so iteration never holds the whole corpus in memory
+        last_row = -1
+        count, overlay = self._count, list(self._overlay)
+        while True:
+            with self._lock:
+                page = self._conn.execute(
+                    "SELECT row_id, entry FROM entries WHERE row_id > ? AND row_id < ? ORDER BY row_id LIMIT 1000",
+                    (last_row, count),
+                ).fetchall()
+            if not page:
+                break
+            for last_row, entry in page:
+                yield json.loads(entry)
+        for entry in overlay:
+            yield dict(entry)
+
+    def append(self, entry):
+        self.extend([entry])
+
+    def _create_field_indexes(self):
+        with self._conn:
+            for field in _COLUMN_FIELDS:
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS entries_{field.lower()} ON entries (row_id, {field})")
+
+    def _upgrade_schema(self):
+        """
+        Add the field columns a store written by an older version lacks, filled from the
+        stored entries. Called by writers (with self._lock held), so opening stays read-only.
+        """
+        missing = [field for field in _COLUMN_FIELDS if field not in self._columns]
+        if not missing:
+            return
+        with self._conn:
+            for field in missing:
+                self._conn.execute(f"ALTER TABLE entries ADD COLUMN {_COLUMN_DEFINITIONS[field]}")
+                self._conn.execute(f"UPDATE entries SET {field} = json_extract(entry, ?)", (f"$.{field}",))
+        self._columns.update(missing)
+        self._create_field_indexes()
+
+    def overlay(self, length, entries):
+        """
+        Serve the first `length` database rows followed by `entries` held in memory, without
+        changing the database. Rows the database has past `length` are hidden until the next
+        write, which replaces them with `entries`.
+        """
+        with self._lock:
+            self._count = min(length, self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0])
+            self._overlay = list(entries)
+
+    def flush(self):
+        """
+        Write the in-memory overlay rows to the database, in place of any rows past them.
+        """
+        with self._lock:
+            if not self._overlay and self._count == self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]:
+                return
+            self._upgrade_schema()
+            rows = [_row_values(self._count + offset, entry) for offset, entry in enumerate(self._overlay)]
+            with self._conn:
+                self._conn.execute("DELETE FROM entries WHERE row_id >= ?", (self._count,))
+                self._conn.executemany(_INSERT_SQL, rows)
+            self._count += len(rows)
+            self._overlay = []
+
+    def extend(self, entries):
+        self.flush()
+        rows = [_row_values(self._count + offset, entry) for offset, entry in enumerate(entries)]
+        if not rows:
+            return
+        with self._lock:
+            self._upgrade_schema()
+            with self._conn:
+                self._conn.executemany(_INSERT_SQL, rows)
+            self._count += len(rows)
+
+    def truncate(self, length):
+        """
+        Delete every row from `length` onwards.
+        """
+        self.flush()
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM entries WHERE row_id >= ?", (length,))
+            self._count = min(self._count, length)
+
+    def field_values(self, field):
+        """
+        Yield (row, value) for one metadata field without decoding whole entries.
+        """
+        with self._lock:
+            if field in _COLUMN_FIELDS and field in self._columns:
+                sql = f"SELECT row_id, {field} FROM entries WHERE row_id < ? ORDER BY row_id"
+                params = (self._count,)
+            else:
+                sql = "SELECT row_id, json_extract(entry, ?) FROM entries WHERE row_id < ? ORDER BY row_id"
+                params = (f"$.{field}", self._count)
+            rows = self._conn.execute(sql, params).fetchall()
+            rows.extend((row, entry.get(field)) for row, entry in enumerate(self._overlay, start=self._count))
+        return iter(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def atomic_write(path, write):
+    """
+    Write a file through `write(binary_file)` into a temporary file next to `path`, fsync it,
+    then rename it over `path`. Readers see either the old or the new file, never a partial one.
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def is_sqlite_path(path):
+    return str(path).lower().endswith(SQLITE_SUFFIXES)
+
+
+def load_metadata(path):
+    """
+    Open the metadata at `path`: a SQLiteMetadataStore for .sqlite/.sqlite3/.db files,
+    otherwise the legacy JSON list.
+    """
+    if is_sqlite_path(path):
+        return SQLiteMetadataStore(path)
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_metadata(metadata, path):
+    """
+    Persist metadata. SQLite stores already wrote their rows on append, so only their
+    overlay rows are written; the legacy JSON list is rewritten (atomically).
+    """
+    if isinstance(metadata, SQLiteMetadataStore):
+        metadata.flush()
+        return
+
+    def write(f):
+        text = io.TextIOWrapper(f, encoding="utf-8")
+        json.dump(metadata, text, indent=4)
+        text.flush()
+        text.detach()
+
+    atomic_write(path, write)
+
+
+def truncate_metadata(metadata, length):
+    """
+    Drop every row from `length` onwards from either metadata backend.
+    """
+    if isinstance(metadata, SQLiteMetadataStore):
+        metadata.truncate(length)
+    else:
+        del metadata[length:]
+
+
+def overlay_metadata(metadata, length, entries):
+    """
+    In memory only, make `metadata` its first `length` rows followed by `entries`. The file
+    is not touched; save_metadata (or the next append to a SQLite store) persists the rows.
+    """
+    if isinstance(metadata, SQLiteMetadataStore):
+        metadata.overlay(length, entries)
+    else:
+        del metadata[length:]
+        metadata.extend(entries)
+
+
+def staged_path(path):
+    """
+    Where a replacement for `path` is written before it is swapped in: "<name>.staged<ext>",
+    so the backend is still recognized by the suffix.
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.staged{ext}"
+
+
+def write_metadata_file(entries, path, batch_size=5000):
+    """
+    Write `entries` as a complete new metadata file at `path` (SQLite or JSON by its suffix),
+    replacing whatever is there.
+    """
+    if not is_sqlite_path(path):
+        save_metadata(list(entries), path)
+        return
+    for leftover in (path, f"{path}-journal"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    store = SQLiteMetadataStore(path)
+    for start in range(0, len(entries), batch_size):
+        store.extend(entries[start:start + batch_size])
+    store.close()
+
+
+def field_values(metadata, field):
+    """
+    Yield (row, value) for one field of either metadata backend.
+    """
+    if isinstance(metadata, SQLiteMetadataStore):
+        return metadata.field_values(field)
+    return ((row, entry.get(field)) for row, entry in enumerate(metadata))
+
+
+def migrate_json_to_sqlite(json_path, sqlite_path, batch_size=5000):
+    """
+    One-shot conversion of a metadata JSON file into a SQLite metadata store.
+    Row order is preserved, so the existing FAISS index stays valid.
+
+    Parameters:
+    - json_path: Path to the existing metadata JSON file.
+    - sqlite_path: Path of the SQLite file to create.
+    - batch_size: Rows inserted per transaction.
+
+    Returns:
+    - Number of rows migrated.
+    """
+    if os.path.exists(sqlite_path):
+        raise FileExistsError(f"{sqlite_path} already exists; refusing to overwrite it.")
+    with open(json_path, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    store = SQLiteMetadataStore(sqlite_path)
+    for start in range(0, len(metadata), batch_size):
+        store.extend(metadata[start:start + batch_size])
+    migrated = len(store)
+    store.close()
+    return migrated
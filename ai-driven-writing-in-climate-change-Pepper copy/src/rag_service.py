@@ -0,0 +1,290 @@
+import base64
+import io
+import json
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import zmq
+
+# The app already binds its drawing publisher on 5555
+DEFAULT_SERVICE_ADDRESS = "tcp://127.0.0.1:5560"
+# How long the server waits for more queries after the first one of a batch
+DEFAULT_BATCH_WINDOW_MS = 5
+DEFAULT_MAX_BATCH_SIZE = 32
+DEFAULT_CLIENT_TIMEOUT_MS = 30000
+# Request latencies kept for the percentiles reported by stats
+LATENCY_SAMPLES = 2048
+# How often the server checks whether the index or metadata changed on disk
+RELOAD_CHECK_SECONDS = 1.0
+
+# query_batch applies one set of options to every query, so only requests with equal options share a batch
+QUERY_OPTIONS = ("k", "text_weight", "image_weight", "filters", "retrieval_mode", "neighbor_window",
+                 "article_token_budget", "search_mode", "lexical_prefilter")
+
+
+class RAGServer:
+    """
+    Long-running retrieval service holding one RAGEngine (CLIP model and FAISS index) for
+    every app process.
+
+    Requests arrive on a ZeroMQ ROUTER socket as JSON. Queries that arrive within
+    `batch_window_ms` of each other (up to `max_batch_size`) are answered with a single
+    RAGEngine.query_batch call, i.e. one CLIP forward pass per tower and one FAISS search.
+    Image queries need an engine that was not started with text_only.
+    """
+
+    def __init__(self, engine, address=DEFAULT_SERVICE_ADDRESS, batch_window_ms=DEFAULT_BATCH_WINDOW_MS,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1.")
+        self.engine = engine
+        self.address = address
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self._context = zmq.Context.instance()
+        self._socket = None
+        self._stop = threading.Event()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._batch_sizes = deque(maxlen=LATENCY_SAMPLES)
+        self._counters = {"requests": 0, "queries": 0, "batches": 0, "errors": 0, "reloads": 0,
+                          "max_queue_depth": 0}
+        self._queue_depth = 0
+        self._started = None
+        self._last_reload_check = 0.0
+
+    def serve_forever(self):
+        """
+        Bind the socket and answer requests until stop() is called (or Ctrl+C).
+        """
+        self._socket = self._context.socket(zmq.ROUTER)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.bind(self.address)
+        self._started = time.time()
+        poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        print(f"[RAG service] Listening on {self.address} (batch window {self.batch_window * 1000:.1f} ms, "
+              f"max batch {self.max_batch_size})")
+        try:
+            while not self._stop.is_set():
+                if not poller.poll(100):
+                    continue
+                self._handle(self._collect_batch(poller))
+        except KeyboardInterrupt:
+            print("[RAG service] Stopping.")
+        finally:
+            self._socket.close()
+            self._socket = None
+
+    def stop(self):
+        self._stop.set()
+
+    def _collect_batch(self, poller):
+        """
+        Read the waiting requests, then keep reading until the batch window closes or the batch is full.
+        """
+        batch = [self._receive()]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            # Drain what is already queued without waiting
+            if self._socket.poll(0, zmq.POLLIN):
+                batch.append(self._receive())
+                continue
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 or not poller.poll(remaining * 1000):
+                break
+        # Take what queued up meanwhile as well (answered in further batches); the total is the queue depth
+        while len(batch) < 4 * self.max_batch_size and self._socket.poll(0, zmq.POLLIN):
+            batch.append(self._receive())
+        self._queue_depth = len(batch)
+        self._counters["max_queue_depth"] = max(self._counters["max_queue_depth"], len(batch))
+        return batch
+
+    def _receive(self):
+        frames = self._socket.recv_multipart()
+        # REQ clients send [identity, empty delimiter, body]
+        identity, body = frames[0], frames[-1]
+        try:
+            request = json.loads(body.decode("utf-8"))
+        except ValueError:
+            request = {"op": "invalid"}
+        return identity, request, time.perf_counter()
+
+    def _reply(self, identity, payload, received):
+        self._socket.send_multipart([identity, b"", json.dumps(payload).encode("utf-8")])
+        self._latencies.append(time.perf_counter() - received)
+
+    def _handle(self, batch):
+        self._counters["requests"] += len(batch)
+        self._maybe_reload()
+        groups = {}
+        for identity, request, received in batch:
+            op = request.get("op")
+            if op == "stats":
+                self._reply(identity, {"ok": True, "stats": self.stats()}, received)
+            elif op == "match_image":
+                self._match_image(identity, request, received)
+            elif op == "query":
+                options = {name: request[name] for name in QUERY_OPTIONS if name in request}
+                key = json.dumps(options, sort_keys=True)
+                groups.setdefault(key, (options, []))[1].append((identity, request, received))
+            else:
+                self._counters["errors"] += 1
+                self._reply(identity, {"ok": False, "error": f"Unknown request '{op}'."}, received)
+
+        for options, requests in groups.values():
+            for start in range(0, len(requests), self.max_batch_size):
+                self._answer_queries(options, requests[start:start + self.max_batch_size])
+
+    def _answer_queries(self, options, requests):
+        texts = [request.get("text_query") for _, request, _ in requests]
+        try:
+            images = [_decode_image(request["image"]) if request.get("image") else None for _, request, _ in requests]
+            outputs = self.engine.query_batch(texts, images, **options)
+        except Exception as e:
+            print(f"Error: query batch failed: {e}")
+            self._counters["errors"] += len(requests)
+            for identity, _, received in requests:
+                self._reply(identity, {"ok": False, "error": str(e)}, received)
+            return
+        self._counters["batches"] += 1
+        self._counters["queries"] += len(requests)
+        self._batch_sizes.append(len(requests))
+        for (identity, _, received), (context, distances, indices) in zip(requests, outputs):
+            self._reply(identity, {"ok": True, "context": list(context), "distances": distances.tolist(),
+                                   "indices": indices.tolist()}, received)
+
+    def _match_image(self, identity, request, received):
+        try:
+            options = {"min_similarity": request["min_similarity"]} if "min_similarity" in request else {}
+            match = self.engine.match_image(request.get("text_query"), **options)
+        except Exception as e:
+            print(f"Error: image match failed: {e}")
+            self._counters["errors"] += 1
+            self._reply(identity, {"ok": False, "error": str(e)}, received)
+            return
+        self._reply(identity, {"ok": True, "match": match}, received)
+
+    def _maybe_reload(self):
+        now = time.perf_counter()
+        if now - self._last_reload_check < RELOAD_CHECK_SECONDS:
+            return
+        self._last_reload_check = now
+        if self.engine.changed_on_disk():
+            start = time.perf_counter()
+            self.engine.reload()
+            self._counters["reloads"] += 1
+            print(f"[RAG service] Reloaded index and metadata in {time.perf_counter() - start:.2f}s")
+
+    def stats(self):
+        """
+        Returns:
+        - Dict with request/batch counters, mean batch size, the queue depth of the last batch,
+          latency percentiles in milliseconds (time from receipt to reply), the engine's cache stats
+          and the resident (rss_mb) and shared memory of the service process.
+        """
+        from RAG import _process_memory_mb
+
+        rss_mb, shared_mb = _process_memory_mb()
+        latencies = np.array(self._latencies) * 1000
+        percentiles = (
+            {f"p{p}": float(np.percentile(latencies, p)) for p in (50, 90, 99)} if len(latencies) else {}
+        )
+        return {
+            **self._counters,
+            "queue_depth": self._queue_depth,
+            "mean_batch_size": float(np.mean(self._batch_sizes)) if self._batch_sizes else 0.0,
+            "latency_ms": percentiles,
+            "uptime_seconds": time.time() - self._started if self._started else 0.0,
+            "query_cache": self.engine.cache_stats(),
+            "rss_mb": rss_mb,
+            "shared_mb": shared_mb,
+        }
+
+
+class RAGClient:
+    """
+    Drop-in replacement for RAGEngine.query that forwards queries to a RAGServer.
+
+    Safe to share between threads: each thread gets its own REQ socket. A socket that timed
+    out is discarded, since a REQ socket cannot send again before it receives a reply.
+    """
+
+    def __init__(self, address=DEFAULT_SERVICE_ADDRESS, timeout_ms=DEFAULT_CLIENT_TIMEOUT_MS):
+        self.address = address
+        self.timeout_ms = timeout_ms
+        self._context = zmq.Context.instance()
+        self._local = threading.local()
+
+    def _request(self, payload):
+        socket = getattr(self._local, "socket", None)
+        if socket is None:
+            socket = self._context.socket(zmq.REQ)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(self.address)
+            self._local.socket = socket
+        socket.send(json.dumps(payload).encode("utf-8"))
+        if not socket.poll(self.timeout_ms, zmq.POLLIN):
+            socket.close()
+            self._local.socket = None
+            raise TimeoutError(f"RAG service at {self.address} did not answer within {self.timeout_ms} ms.")
+        response = json.loads(socket.recv().decode("utf-8"))
+        if not response.get("ok"):
+            raise RuntimeError(f"RAG service error: {response.get('error')}")
+        return response
+
+    def query(self, text_query=None, image=None, k=5, **options):
+        """
+        Same arguments and return value as RAGEngine.query. The image (a PIL.Image) is sent
+        PNG-encoded; the service must not run with --text_only to answer it.
+        """
+        unknown = set(options) - set(QUERY_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unsupported query options: {', '.join(sorted(unknown))}.")
+        payload = {"op": "query", "text_query": text_query, "k": k, **options}
+        if image is not None:
+            payload["image"] = _encode_image(image)
+        response = self._request(payload)
+        return (response["context"], np.array(response["distances"], dtype=np.float32),
+                np.array(response["indices"], dtype=np.int64))
+
+    def match_image(self, text_query, min_similarity=None):
+        """
+        Same as RAGEngine.match_image.
+        """
+        payload = {"op": "match_image", "text_query": text_query}
+        if min_similarity is not None:
+            payload["min_similarity"] = min_similarity
+        return self._request(payload)["match"]
+
+    def stats(self):
+        return self._request({"op": "stats"})["stats"]
+
+
+def _encode_image(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def _decode_image(payload):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(base64.b64decode(payload)))
+    image.load()
+    return image
+
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_rag_client(address=DEFAULT_SERVICE_ADDRESS):
+    """
+    Return the shared RAGClient for `address` (one per process, like get_rag_engine).
+    """
+    with _CLIENTS_LOCK:
+        if address not in _CLIENTS:
+            _CLIENTS[address] = RAGClient(address)
+        return _CLIENTS[address]
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+from metadata_store import atomic_write
+
+# shard-<shard number>.npy, written once the whole shard is encoded
+_SHARD_NAME = re.compile(r"^shard-(\d{6})\.npy$")
+MANIFEST_NAME = "manifest.json"
+# Index path of the worker engines: never written, it keeps their lock and side files in the
+# rebuild directory instead of the working directory
+WORKER_INDEX_NAME = "worker.idx"
+
+# Per-process engine of a rebuild worker, created by init_worker
+_WORKER_ENGINE = None
+
+
+def rebuild_fingerprint(model_key, shard_size, items):
+    """
+    Identify the work of a rebuild: the model and inference backend (as in the embedding cache
+    keys), the shard size and every (row, kind, payload) to encode. A checkpoint is only
+    resumed when this matches.
+    """
+    digest = hashlib.sha256(f"{model_key}\0{shard_size}".encode("utf-8"))
+    for row, kind, payload in items:
+        digest.update(f"\0{row}\0{kind}\0{payload}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def prepare_work_dir(work_dir, fingerprint):
+    """
+    Open the checkpoint directory of a rebuild, discarding shards left by a rebuild of
+    different data.
+
+    Returns:
+    - Set of shard numbers already encoded.
+    """
+    manifest_path = os.path.join(work_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("fingerprint") != fingerprint:
+            print(f"Discarding rebuild checkpoint in {work_dir}: the metadata or settings changed.")
+            for name in os.listdir(work_dir):
+                if _SHARD_NAME.match(name):
+                    os.remove(os.path.join(work_dir, name))
+    os.makedirs(work_dir, exist_ok=True)
+    # Temporary files of shards that were being written when the rebuild was killed
+    for name in os.listdir(work_dir):
+        if ".tmp-" in name:
+            os.remove(os.path.join(work_dir, name))
+    payload = json.dumps({"fingerprint": fingerprint}).encode("utf-8")
+    atomic_write(manifest_path, lambda f: f.write(payload))
+    return {int(match.group(1)) for match in map(_SHARD_NAME.match, os.listdir(work_dir)) if match}
+
+
+def shard_path(work_dir, shard):
+    return os.path.join(work_dir, f"shard-{shard:06d}.npy")
+
+
+def read_shard(work_dir, shard):
+    return np.load(shard_path(work_dir, shard))
+
+
+def init_worker(clip_model_name, inference_backend, num_threads, text_only, work_dir):
+    """
+    Process initializer: load CLIP once per worker process.
+    """
+    global _WORKER_ENGINE
+    from RAG import RAGEngine  # imported here: RAG imports this module
+
+    _WORKER_ENGINE = RAGEngine(index_path=os.path.join(work_dir, WORKER_INDEX_NAME), clip_model_name=clip_model_name,
+                               query_cache_size=0, inference_backend=inference_backend, num_threads=num_threads,
+                               text_only=text_only)
+
+
+def encode_shard(work_dir, shard, kinds, payloads, batch_size):
+    """
+    Encode one shard in a worker process and atomically write its normalized embeddings.
+
+    Parameters:
+    - work_dir: Checkpoint directory.
+    - shard: Shard number.
+    - kinds: "text" or "image" per item.
+    - payloads: Text content or image path per item.
+    - batch_size: Items per CLIP forward pass.
+
+    Returns:
+    - (shard, number of items, seconds).
+    """
+    start = time.perf_counter()
+    engine = _WORKER_ENGINE
+    embeddings = np.empty((len(kinds), engine._embedding_dim()), dtype=np.float32)
+    for kind in ("text", "image"):
+        positions = [i for i, item_kind in enumerate(kinds) if item_kind == kind]
+        if not positions:
+            continue
+        items = [payloads[i] for i in positions]
+        if kind == "text":
+            embeddings[positions] = engine._encode_text(items, batch_size)
+        else:
+            embeddings[positions] = engine._encode_image(image_paths=items, batch_size=batch_size)
+    embeddings = engine._normalize_embeddings(embeddings).astype(np.float32)
+    atomic_write(shard_path(work_dir, shard), lambda f: np.save(f, embeddings))
+    return shard, len(kinds), time.perf_counter() - start
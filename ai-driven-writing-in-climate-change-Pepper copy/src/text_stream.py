@@ -0,0 +1,83 @@
+import json
+import os
+
+from metadata_store import atomic_write
+
+# A paragraph longer than this is cut at the next line break, so a file without blank
+# lines still streams in bounded pieces
+DEFAULT_MAX_PARAGRAPH_CHARS = 1 << 20
+
+
+def iter_paragraphs(file_path, start_offset=0, max_paragraph_chars=DEFAULT_MAX_PARAGRAPH_CHARS):
+    """
+    Stream the blank-line separated paragraphs of a UTF-8 text file.
+
+    Parameters:
+    - file_path: Path to the text file.
+    - start_offset: Byte offset to start reading from (a paragraph boundary from an earlier run).
+    - max_paragraph_chars: Paragraphs are cut at a line break once they grow past this size.
+
+    Returns:
+    - Generator of (paragraph, end_offset): the stripped paragraph text and the byte offset
+      just past it, from which reading can resume.
+    """
+    with open(file_path, "rb") as f:
+        f.seek(start_offset)
+        lines = []
+        size = 0
+        offset = start_offset
+        for raw_line in f:
+            offset += len(raw_line)
+            line = raw_line.decode("utf-8", errors="replace")
+            if line.strip():
+                lines.append(line)
+                size += len(line)
+                if size < max_paragraph_chars:
+                    continue
+            if lines:
+                yield "".join(lines).strip(), offset
+                lines = []
+                size = 0
+        if lines:
+            yield "".join(lines).strip(), offset
+
+
+def checkpoint_path_for(file_path):
+    return f"{file_path}.ingest.json"
+
+
+def load_checkpoint(path, metadata_rows):
+    """
+    Byte offset to resume a streaming ingestion from.
+
+    The checkpoint is written twice per batch: with the batch marked "pending" before its rows
+    are committed, and without it afterwards. If the process died in between, the metadata
+    length tells whether the pending batch made it in.
+
+    Parameters:
+    - path: Checkpoint file.
+    - metadata_rows: Current number of metadata rows of the engine.
+
+    Returns:
+    - Byte offset into the source file (0 without a checkpoint).
+    """
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path, "r", encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    pending = checkpoint.get("pending")
+    if pending and metadata_rows >= pending["rows"]:
+        return pending["offset"]
+    if metadata_rows < checkpoint["rows"]:
+        print(f"Warning: checkpoint {path} expects {checkpoint['rows']} metadata rows but there are "
+              f"{metadata_rows}; resuming from its offset anyway.")
+    return checkpoint["offset"]
+
+
+def save_checkpoint(path, offset, rows, pending=None):
+    """
+    Atomically record that the source was consumed up to `offset` with `rows` metadata rows,
+    plus an optional {"offset", "rows"} batch that is about to be committed.
+    """
+    payload = json.dumps({"offset": offset, "rows": rows, "pending": pending}).encode("utf-8")
+    atomic_write(path, lambda f: f.write(payload))